@@ -1,12 +1,28 @@
+import atexit
+import hashlib
+import io
+import itertools
+import json
 import logging
 import os
+import queue
 import re
+import shlex
+import shutil
+import sqlite3
 import sys
 import tempfile
-from subprocess import Popen, PIPE
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from subprocess import Popen, PIPE, TimeoutExpired
 
 from . import dotparsing
-from .utils import nsplit, chunks, escape_texchars, smart_float, replace_tags, is_multiline_label
+from .utils import chunks, escape_texchars, smart_float, is_multiline_label
 
 # initialize logging module
 log = logging.getLogger("dot2tex")
@@ -20,12 +36,33 @@ DEFAULT_EDGELABEL_XMARGIN = 0.01
 DEFAULT_EDGELABEL_YMARGIN = 0.01
 
 
-def create_xdot(dotdata, prog='dot', options=''):
-    """Run a graph through Graphviz and return an xdot-version of the graph"""
-    # The following code is from the pydot module written by Ero Carrera
-    progs = dotparsing.find_graphviz()
+def parse_graphviz_messages(error_data):
+    """Split the stderr output of Graphviz into (level, message) tuples
+
+    level is 'error', 'warning' or 'info'. Lines that do not start a new
+    message are continuation lines of the previous one.
+    """
+    if isinstance(error_data, bytes):
+        error_data = error_data.decode('utf8', 'replace')
+    messages = []
+    for line in error_data.splitlines():
+        if not line.strip():
+            continue
+        m = re.match(r'\s*(?:\S+: )?(Error|Warning)\s*:?\s*(.*)', line)
+        if m:
+            messages.append((m.group(1).lower(), m.group(2)))
+        elif messages and line[:1].isspace():
+            level, message = messages[-1]
+            messages[-1] = (level, message + '\n' + line.strip())
+        else:
+            messages.append(('info', line.strip()))
+    return messages
+
+
+def graphviz_args(prog='dot', options='', graphvizdir=None, output_format='xdot'):
+    """Return the argument list for running a Graphviz layout program, or None"""
+    progs = dotparsing.find_graphviz(graphvizdir)
 
-    # prog = 'dot'
     if progs is None:
         log.error('Could not locate Graphviz binaries')
         return None
@@ -33,161 +70,1058 @@ def create_xdot(dotdata, prog='dot', options=''):
         log.error('Invalid prog=%s', prog)
         raise NameError('The %s program is not recognized. Valid values are %s' % (prog, list(progs)))
 
-    tmp_fd, tmp_name = tempfile.mkstemp()
-    os.close(tmp_fd)
-    if os.sys.version_info[0] >= 3:
-        with open(tmp_name, 'w', encoding="utf8") as f:
-            f.write(dotdata)
-    else:
-        with open(tmp_name, 'w') as f:
-            f.write(dotdata)
-    output_format = 'xdot'
-    progpath = '"%s"' % progs[prog].strip()
-    cmd = progpath + ' -T' + output_format + ' ' + options + ' ' + tmp_name
-    log.debug('Creating xdot data with: %s', cmd)
-    p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, close_fds=(sys.platform != 'win32'))
-    (stdout, stderr) = (p.stdout, p.stderr)
-    try:
-        data = stdout.read()
-    finally:
-        stdout.close()
+    progpath = progs[prog].strip().strip('"')
+    return [progpath, '-T' + output_format] + shlex.split(options or '', posix=(sys.platform != 'win32'))
+
+
+def log_graphviz_messages(messages):
+    for level, message in messages:
+        if level == 'error':
+            log.error("Graphviz returned with the following message: %s", message)
+        else:
+            # Graphviz raises a lot of warnings about too small labels,
+            # we therefore log them using log.debug to "hide" them
+            log.debug('Graphviz STDERR %s', message)
+
+
+_gv = None
+_gv_lock = threading.RLock()
+
+
+def get_gv():
+    """Return the Graphviz gv Python binding, or None if it is not installed"""
+    global _gv
+    with _gv_lock:
+        if _gv is None:
+            try:
+                import gv
+                _gv = gv
+            except ImportError:
+                log.debug('The gv Python binding is not installed')
+                _gv = False
+        return _gv or None
+
+
+def run_gv(dotdata, prog='dot', options='', output_format='xdot'):
+    """Lay out and render a graph in-process with the gv Python binding
+
+    Only -G, -N and -E options can be passed on. Returns the rendered graph
+    as bytes, or None if the binding is missing, an option is not supported
+    or the graph could not be laid out.
+    """
+    gv = get_gv()
+    if gv is None:
+        return None
+    attrs = []
+    for option in shlex.split(options or ''):
+        m = re.match(r'-([GNE])([^=]+)=(.*)$', option)
+        if not m:
+            return None
+        attrs.append(m.groups())
+    if isinstance(dotdata, bytes):
+        dotdata = dotdata.decode('utf8')
+    # the binding shares one Graphviz context and is not thread-safe
+    with _gv_lock:
+        g = gv.readstring(dotdata)
+        if g is None:
+            return None
+        try:
+            for kind, name, value in attrs:
+                target = {'G': g, 'N': gv.protonode(g), 'E': gv.protoedge(g)}[kind]
+                gv.setv(target, name, value)
+            if not gv.layout(g, prog):
+                return None
+            data = gv.renderdata(g, output_format)
+        finally:
+            gv.rm(g)
+    if data is None:
+        return None
+    return data.encode('utf8')
+
+
+def run_graphviz(dotdata, prog='dot', options='', graphvizdir=None, output_format='xdot', timeout=None,
+                 workers=None, gvbinding=True):
+    """Run a graph through Graphviz
 
+    The graph is passed on stdin and both output streams are read at the
+    same time, so a lot of warnings can not block Graphviz. Returns a
+    (data, messages) tuple, where messages are the stderr diagnostics as
+    returned by parse_graphviz_messages. data is None if Graphviz could not
+    be run, failed or did not finish within timeout seconds.
+
+    If the gv Python binding is installed, gvbinding is true and neither
+    graphvizdir nor timeout is given, the graph is laid out in-process with
+    run_gv. The binding can not be interrupted.
+    Otherwise, if workers, or else the DOT2TEX_GRAPHVIZ_WORKERS environment
+    variable, is a positive number, the graph is sent to a pool of that
+    many persistent Graphviz processes instead of starting a new one.
+    """
+    if gvbinding and not graphvizdir and timeout is None:
+        data = run_gv(dotdata, prog, options, output_format)
+        if data is not None:
+            return data, []
+    if workers is None:
+        workers = os.environ.get(GRAPHVIZ_WORKERS_ENV)
+        try:
+            workers = int(workers or 0)
+        except ValueError:
+            log.warning('Ignoring %s=%s, which is not a number', GRAPHVIZ_WORKERS_ENV, workers)
+            workers = 0
+    if workers and workers > 0 and output_format in GRAPHVIZ_FRAME_END:
+        pool = get_graphviz_pool(prog, options, graphvizdir, output_format, workers)
+        if pool is not None:
+            try:
+                return pool.layout(dotdata, timeout)
+            except GraphvizTimeout:
+                log.error('%s did not finish within %s seconds', prog, timeout)
+                return None, [('error', '%s did not finish within %s seconds' % (prog, timeout))]
+            except GraphvizWorkerError as err:
+                # run it once more on its own to get the full diagnostics
+                log.debug('Graphviz worker failed (%s). Running %s directly', err, prog)
+
+    args = graphviz_args(prog, options, graphvizdir, output_format)
+    if args is None:
+        return None, [('error', 'Could not locate Graphviz binaries')]
+    log.debug('Running Graphviz: %s', args)
+    if not isinstance(dotdata, bytes):
+        dotdata = dotdata.encode('utf8')
     try:
-        error_data = stderr.read()
-        if error_data:
-            if b'Error:' in error_data:
-                log.error("Graphviz returned with the following message: %s", error_data)
+        p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=(sys.platform != 'win32'))
+    except OSError as err:
+        log.error('Failed to run %s: %s', args[0], err)
+        return None, [('error', 'Failed to run %s: %s' % (args[0], err))]
+    try:
+        data, error_data = p.communicate(dotdata, timeout=timeout)
+    except TimeoutExpired:
+        p.kill()
+        p.communicate()
+        log.error('%s did not finish within %s seconds', prog, timeout)
+        return None, [('error', '%s did not finish within %s seconds' % (prog, timeout))]
+
+    messages = parse_graphviz_messages(error_data)
+    log_graphviz_messages(messages)
+    if p.returncode:
+        log.error('%s exited with status %s', prog, p.returncode)
+        if not data:
+            return None, messages
+    return data, messages
+
+
+# Environment variable with the number of persistent Graphviz processes per
+# layout program. Not set or 0 runs a new process for every graph.
+GRAPHVIZ_WORKERS_ENV = 'DOT2TEX_GRAPHVIZ_WORKERS'
+
+# The last line of a rendered graph in the output formats the workers support
+GRAPHVIZ_FRAME_END = {'xdot': b'}', 'dot': b'}', 'json': b'}', 'plain': b'stop', 'svg': b'</svg>'}
+
+# Sent after every graph. The Graphviz parser may read one token past the
+# end of a graph before it lays it out, so the graph is followed by two sync
+# graphs: the first provides the token after the graph and the second the
+# token after the first. Only the output of the first is read with the
+# graph, the output of the second is read before the next graph. The output
+# of a graph can contain lines that look like the end of a frame, so each
+# frame is checked for the name of the sync graph. The unknown shape makes
+# Graphviz write a warning after the messages about the graph on stderr. It
+# is numbered, as Graphviz warns only once per shape.
+GRAPHVIZ_SYNC_GRAPH = '\ngraph dot2tex_sync {dot2tex_sync [shape=dot2tex_sync_%d]}\n'
+GRAPHVIZ_SYNC_TAIL = b'graph dot2tex_sync {}\n'
+GRAPHVIZ_SYNC_NAME = b'dot2tex_sync'
+
+# Seconds to wait for the sync warning on stderr after the output of the
+# sync graph has been read
+GRAPHVIZ_SYNC_STDERR_WAIT = 1.0
+
+
+class GraphvizWorkerError(Exception):
+    """A Graphviz worker process died or did not respond"""
+
+
+class GraphvizTimeout(GraphvizWorkerError):
+    """A Graphviz worker did not finish in time"""
+
+
+class GraphvizWorker(object):
+    """A long-running Graphviz process that lays out one graph at a time
+
+    Graphs are written to stdin, each followed by GRAPHVIZ_SYNC_GRAPH and
+    GRAPHVIZ_SYNC_TAIL. The output is split into frames on the last line of
+    the output format. The frame of a graph must not contain the name of the
+    sync graph and the frames of the sync graphs must, otherwise the worker
+    is broken and the graph is run on its own instead.
+    """
+
+    def __init__(self, args, output_format='xdot'):
+        self.args = args
+        self.frame_end = GRAPHVIZ_FRAME_END[output_format]
+        self.process = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=(sys.platform != 'win32'))
+        self.lines = queue.Queue()
+        self.errors = []
+        self.errors_cond = threading.Condition()
+        # false once a sync warning has not arrived, for instance with -q
+        self.sync_warnings = True
+        # true while the output of the last GRAPHVIZ_SYNC_TAIL has not been read
+        self.pending = False
+        self.broken = False
+        self.count = 0
+        for target in (self._read_stdout, self._read_stderr):
+            thread = threading.Thread(target=target, name='dot2tex-graphviz')
+            thread.daemon = True
+            thread.start()
+
+    def _read_stdout(self):
+        for line in iter(self.process.stdout.readline, b''):
+            self.lines.put(line)
+        self.lines.put(None)
+
+    def _read_stderr(self):
+        for line in iter(self.process.stderr.readline, b''):
+            with self.errors_cond:
+                self.errors.append(line)
+                self.errors_cond.notify()
+
+    def alive(self):
+        return not self.broken and self.process.poll() is None
+
+    def _read_graph(self, deadline):
+        lines = []
+        while True:
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                line = self.lines.get(timeout=timeout)
+            except queue.Empty:
+                self.broken = True
+                raise GraphvizTimeout('timed out')
+            if line is None:
+                self.broken = True
+                raise GraphvizWorkerError('%s exited with status %s' % (self.args[0], self.process.wait()))
+            lines.append(line)
+            if line.rstrip() == self.frame_end:
+                return b''.join(lines)
+
+    def _read_sync(self, deadline):
+        if GRAPHVIZ_SYNC_NAME not in self._read_graph(deadline):
+            self.broken = True
+            raise GraphvizWorkerError('the end of the output of the graph could not be found')
+
+    def _read_errors(self, marker, deadline):
+        """Return the stderr output up to the warning about the sync graph"""
+        wait = GRAPHVIZ_SYNC_STDERR_WAIT if self.sync_warnings else 0
+        if deadline is not None:
+            wait = min(wait, max(deadline - time.time(), 0))
+        end = time.time() + wait
+        with self.errors_cond:
+            while True:
+                for i, line in enumerate(self.errors):
+                    if marker in line:
+                        error_data = b''.join(self.errors[:i])
+                        del self.errors[:i + 1]
+                        return error_data
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self.errors_cond.wait(remaining)
+            if self.sync_warnings:
+                log.debug('Graphviz did not warn about the sync graph. '
+                          'Its messages may be attributed to the wrong graph')
+                self.sync_warnings = False
+            error_data = b''.join(self.errors)
+            del self.errors[:]
+            return error_data
+
+    def layout(self, dotdata, timeout=None):
+        """Lay out a graph. Returns a (data, messages) tuple like run_graphviz"""
+        if not isinstance(dotdata, bytes):
+            dotdata = dotdata.encode('utf8')
+        deadline = None if timeout is None else time.time() + timeout
+        self.count += 1
+        marker = b'dot2tex_sync_%d' % self.count
+        try:
+            self.process.stdin.write(dotdata + (GRAPHVIZ_SYNC_GRAPH % self.count).encode('ascii')
+                                     + GRAPHVIZ_SYNC_TAIL)
+            self.process.stdin.flush()
+        except (IOError, OSError) as err:
+            self.broken = True
+            raise GraphvizWorkerError(str(err))
+        if self.pending:
+            self._read_sync(deadline)
+            self.pending = False
+        data = self._read_graph(deadline)
+        if GRAPHVIZ_SYNC_NAME in data:
+            self.broken = True
+            raise GraphvizWorkerError('no output for the graph')
+        self._read_sync(deadline)
+        self.pending = True
+        return data, parse_graphviz_messages(self._read_errors(marker, deadline))
+
+    def ping(self, timeout=5):
+        """Check that the process still answers"""
+        try:
+            self.layout(b'graph dot2tex_ping {}', timeout)
+        except GraphvizWorkerError:
+            return False
+        return True
+
+    def close(self):
+        """Stop the process. A broken process is killed right away"""
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if not self.broken:
+            try:
+                self.process.wait(timeout=1)
+            except TimeoutExpired:
+                pass
+        self.broken = True
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+class GraphvizPool(object):
+    """A pool of at most maxworkers GraphvizWorkers running the same command
+
+    Workers are started when needed and replaced when they die.
+    """
+
+    def __init__(self, args, output_format='xdot', maxworkers=2):
+        self.args = args
+        self.output_format = output_format
+        self.maxworkers = maxworkers
+        self._idle = []
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                while self._idle:
+                    worker = self._idle.pop()
+                    if worker.alive():
+                        return worker
+                    self._discard(worker)
+                if self._count < self.maxworkers:
+                    self._count += 1
+                    break
+                self._cond.wait()
+        try:
+            log.debug('Starting Graphviz worker: %s', self.args)
+            return GraphvizWorker(self.args, self.output_format)
+        except OSError as err:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise GraphvizWorkerError('Failed to run %s: %s' % (self.args[0], err))
+
+    def _discard(self, worker):
+        # called with the lock held
+        log.debug('Discarding Graphviz worker after %d graphs', worker.count)
+        worker.close()
+        self._count -= 1
+
+    def _release(self, worker):
+        with self._cond:
+            if worker.alive():
+                self._idle.append(worker)
             else:
-                # Graphviz raises a lot of warnings about too small labels,
-                # we therefore log them using log.debug to "hide" them
-                log.debug('Graphviz STDERR %s', error_data)
-    finally:
-        stderr.close()
-    p.kill()
-    p.wait()
+                self._discard(worker)
+            self._cond.notify()
+
+    def layout(self, dotdata, timeout=None):
+        """Lay out a graph with one of the workers. See GraphvizWorker.layout"""
+        worker = self._acquire()
+        try:
+            data, messages = worker.layout(dotdata, timeout)
+        finally:
+            self._release(worker)
+        log_graphviz_messages(messages)
+        return data, messages
+
+    def check(self, timeout=5):
+        """Ping the idle workers and discard those that do not answer
+
+        Returns the number of healthy workers.
+        """
+        with self._cond:
+            workers, self._idle = self._idle, []
+        healthy = 0
+        for worker in workers:
+            if worker.alive() and worker.ping(timeout):
+                healthy += 1
+            self._release(worker)
+        return healthy
+
+    def close(self):
+        """Stop the idle workers"""
+        with self._cond:
+            for worker in self._idle:
+                self._discard(worker)
+            self._idle = []
+
+
+_graphviz_pools = {}
+_graphviz_pools_lock = threading.Lock()
+
 
-    os.unlink(tmp_name)
+def get_graphviz_pool(prog='dot', options='', graphvizdir=None, output_format='xdot', maxworkers=2):
+    """Return the process-wide worker pool for a layout program, or None
+
+    The pool size is set when the pool is first requested.
+    """
+    args = graphviz_args(prog, options, graphvizdir, output_format)
+    if args is None:
+        return None
+    key = tuple(args)
+    with _graphviz_pools_lock:
+        pool = _graphviz_pools.get(key)
+        if pool is None:
+            pool = _graphviz_pools[key] = GraphvizPool(args, output_format, maxworkers)
+        return pool
+
+
+@atexit.register
+def close_graphviz_pools():
+    """Stop all Graphviz workers"""
+    with _graphviz_pools_lock:
+        pools = list(_graphviz_pools.values())
+        _graphviz_pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def create_xdot(dotdata, prog='dot', options='', graphvizdir=None, timeout=None, workers=None,
+                gvbinding=True, cache=None):
+    """Run a graph through Graphviz and return an xdot-version of the graph
+
+    graphvizdir overrides where the Graphviz executables are looked for.
+    See run_graphviz for the diagnostics and the worker pool. If cache is a
+    LayoutCache the layout is looked up there first.
+    """
+    layout = cache.run_graphviz if cache is not None else run_graphviz
+    data, messages = layout(dotdata, prog, options, graphvizdir, timeout=timeout, workers=workers,
+                            gvbinding=gvbinding)
     return data
 
 
-def parse_dot_data(dotdata):
+# Change when the format of the layout cache entries changes
+LAYOUT_CACHE_VERSION = 2
+
+
+class LayoutCache(object):
+    """Cache of Graphviz output keyed by the graph, layout program and Graphviz version
+
+    The compressed output is kept in an in-memory LRU of at most maxbytes
+    and, if cachedir is given, in one file per layout in cachedir. When the
+    files take up more than maxdiskbytes the least recently used are
+    removed. Failed layouts are not cached.
+
+    An entry is a line of JSON with the Graphviz messages followed by the
+    output as it was returned, so that reading a file written by someone
+    else can not run code. Values other than text, such as the records of
+    get_pinned_layout(), are stored as JSON.
+    """
+
+    def __init__(self, maxbytes=32 << 20, cachedir=None, maxdiskbytes=256 << 20):
+        self.maxbytes = maxbytes
+        self.cachedir = cachedir
+        self.maxdiskbytes = maxdiskbytes
+        self._entries = OrderedDict()
+        self._size = 0
+        # estimate of the size of cachedir. None until it is first needed
+        self._disksize = None
+        self._lock = threading.Lock()
+
+    def key(self, dotdata, prog='dot', options='', output_format='xdot', version=None):
+        """Return the cache key for a layout, or None if the Graphviz version is unknown"""
+        if version is None:
+            return None
+        if isinstance(dotdata, bytes):
+            dotdata = dotdata.decode('utf8', 'surrogateescape')
+        dotdata = dotdata.replace('\r\n', '\n').replace('\\\n', '').strip()
+        m = hashlib.sha256()
+        m.update(('%s\0%s\0%s\0%s\0%s\0' % (LAYOUT_CACHE_VERSION, version, prog,
+                                            ' '.join(shlex.split(options or '')),
+                                            output_format)).encode('utf8'))
+        m.update(dotdata.encode('utf8', 'surrogateescape'))
+        return m.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key + '.layout')
+
+    def get(self, key):
+        """Return the cached (data, messages) tuple, or None"""
+        with self._lock:
+            blob = self._entries.get(key)
+            if blob is not None:
+                self._entries.move_to_end(key)
+        if blob is None and self.cachedir:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    blob = f.read()
+                # the modification time orders the files for eviction
+                os.utime(path, None)
+            except (IOError, OSError):
+                return None
+            self._remember(key, blob)
+        if blob is None:
+            return None
+        try:
+            return self._load(blob)
+        except Exception:
+            log.warning('Discarding unreadable layout cache entry %s', key)
+            with self._lock:
+                blob = self._entries.pop(key, None)
+                if blob is not None:
+                    self._size -= len(blob)
+            return None
+
+    def put(self, key, data, messages=()):
+        """Store the output of Graphviz and its diagnostics"""
+        blob = self._dump(data, messages)
+        self._remember(key, blob)
+        if not self.cachedir:
+            return
+        try:
+            dotparsing.write_file_atomically(self._path(key), blob)
+        except (IOError, OSError) as err:
+            log.warning('Failed to write layout cache entry: %s', err)
+            return
+        with self._lock:
+            if self._disksize is not None:
+                self._disksize += len(blob)
+            full = self._disksize is None or self._disksize > self.maxdiskbytes
+        if full:
+            self.prune()
+
+    @staticmethod
+    def _dump(data, messages):
+        header = {'messages': [list(message) for message in messages]}
+        if isinstance(data, bytes):
+            payload = data
+        elif isinstance(data, str):
+            header['type'] = 'text'
+            payload = data.encode('utf8', 'surrogateescape')
+        else:
+            header['type'] = 'json'
+            payload = json.dumps(data).encode('utf8')
+        return zlib.compress(json.dumps(header).encode('utf8') + b'\n' + payload, 1)
+
+    @staticmethod
+    def _load(blob):
+        header, payload = zlib.decompress(blob).split(b'\n', 1)
+        header = json.loads(header.decode('utf8'))
+        kind = header.get('type')
+        if kind == 'text':
+            data = payload.decode('utf8', 'surrogateescape')
+        elif kind == 'json':
+            data = json.loads(payload.decode('utf8'))
+        else:
+            data = payload
+        return data, [tuple(message) for message in header['messages']]
+
+    def prune(self):
+        """Remove the least recently used files until cachedir is below maxdiskbytes"""
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.cachedir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.layout'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cachedir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+            total += st.st_size
+        entries.sort()
+        for mtime, name, size in entries:
+            if total <= self.maxdiskbytes:
+                break
+            try:
+                os.remove(os.path.join(self.cachedir, name))
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._disksize = total
+
+    def clear(self):
+        """Empty the in-memory tier"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _remember(self, key, blob):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = blob
+            self._size += len(blob)
+            while self._size > self.maxbytes and len(self._entries) > 1:
+                self._size -= len(self._entries.popitem(last=False)[1])
+
+    def run_graphviz(self, dotdata, prog='dot', options='', graphvizdir=None, output_format='xdot',
+                     **kwds):
+        """run_graphviz, or the cached result of an earlier identical run"""
+        key = self.key(dotdata, prog, options, output_format, dotparsing.get_graphviz_version(graphvizdir))
+        if key is not None:
+            result = self.get(key)
+            if result is not None:
+                log.debug('Layout cache hit for %s', key)
+                log_graphviz_messages(result[1])
+                return result
+        data, messages = run_graphviz(dotdata, prog, options, graphvizdir, output_format, **kwds)
+        if key is not None and data is not None:
+            self.put(key, data, messages)
+        return data, messages
+
+
+# Attributes that do not change the layout
+LAYOUT_STYLE_ATTRS = frozenset((
+    'color', 'fillcolor', 'fontcolor', 'pencolor', 'bgcolor', 'labelfontcolor', 'colorscheme',
+    'gradientangle', 'style', 'penwidth', 'comment', 'tooltip', 'URL', 'href', 'target', 'id', 'class',
+    'texlbl', 'tailtexlbl', 'headtexlbl', 'texmode', 'lblstyle', 'exstyle', 'topath'))
+
+# Attributes of nodes and edges that change the size of labels and nodes,
+# but not the structure of the layout
+LAYOUT_LABEL_ATTRS = frozenset((
+    'label', 'xlabel', 'headlabel', 'taillabel', 'fontsize', 'fontname', 'labelfontsize',
+    'labelfontname', 'shape', 'width', 'height', 'fixedsize', 'margin', 'peripheries', 'sides',
+    'orientation', 'distortion', 'skew', 'regular', 'nojustify'))
+
+# Attributes of edges that are kept when the edges of a layout are reused
+PINNED_EDGE_ATTRS = ('pos', 'lp', 'head_lp', 'tail_lp', 'xlp')
+
+
+def _hash_parts(m, *parts):
+    m.update(('\0'.join(parts) + '\n').encode('utf8', 'surrogatepass'))
+
+
+def layout_structure_key(graph, prog='dot', options='', version=None):
+    """Return a hash of everything in graph that can change its layout
+
+    Graphs with the same key only differ in their styles and in the
+    LAYOUT_LABEL_ATTRS of the nodes and edges.
+    """
+    m = hashlib.sha256()
+    _hash_parts(m, 'layout', str(LAYOUT_CACHE_VERSION), str(version), prog,
+                ' '.join(shlex.split(options or '')), str(graph.directed), str(graph.strict))
+    for g in graph.allgraphs:
+        _hash_parts(m, 'graph', g.name, *g.get_all_nodes())
+        for key, value in sorted(g.attr.items()):
+            if key not in LAYOUT_STYLE_ATTRS and not key.startswith('d2t'):
+                _hash_parts(m, key, str(value))
+    skip = LAYOUT_STYLE_ATTRS | LAYOUT_LABEL_ATTRS
+    for node in graph.allnodes:
+        _hash_parts(m, 'node', node.name,
+                    *['%s=%s' % item for item in sorted(node.attr.items()) if item[0] not in skip])
+    for edge in graph.alledges:
+        _hash_parts(m, 'edge', edge.src.name, edge.dst.name, edge.src_port, edge.dst_port,
+                    *['%s=%s' % item for item in sorted(edge.attr.items()) if item[0] not in skip])
+    return m.hexdigest()
+
+
+def layout_label_key(graph):
+    """Return a hash of the LAYOUT_LABEL_ATTRS of the nodes and edges of graph"""
+    m = hashlib.sha256()
+    for element in itertools.chain(graph.allnodes, graph.alledges):
+        _hash_parts(m, *['%s=%s' % (key, element.attr[key])
+                         for key in sorted(LAYOUT_LABEL_ATTRS.intersection(element.attr))])
+    return m.hexdigest()
+
+
+def get_pinned_layout(graph, laid_out):
+    """Return the positions in laid_out, the layout of graph, for pin_layout"""
+    record = {'labels': layout_label_key(graph), 'nodes': {}, 'edges': [], 'graphs': {}}
+    for node in laid_out.allnodes:
+        pos = node.attr.get('pos')
+        if pos:
+            record['nodes'][node.name] = str(pos).rstrip('!')
+    for edge in laid_out.alledges:
+        key = [edge.src.name, edge.dst.name, edge.src_port, edge.dst_port]
+        record['edges'].append([key, [edge.attr.get(name) for name in PINNED_EDGE_ATTRS]])
+    # the other subgraphs are not drawn and inherit bb from their parents
+    for g in laid_out.allgraphs:
+        if g is not laid_out and g.name.startswith('cluster'):
+            record['graphs'][g.name] = (g.attr.get('bb'), g.attr.get('lp'))
+    return record
+
+
+def pin_layout(graph, record, keepedges=False):
+    """Fix the nodes of graph at the positions in record from get_pinned_layout
+
+    If keepedges is true the edges are fixed as well. Otherwise spline
+    edges are requested, as neato draws straight edges by default.
+    Returns False if a node or edge of graph is missing in record.
+    """
+    positions = record['nodes']
+    for node in graph.allnodes:
+        pos = positions.get(node.name)
+        if pos is None:
+            return False
+        node.attr['pos'] = pos + '!'
+    if graph.allitems:
+        # graph is written statement by statement. Add statements for the
+        # nodes that are only created by edges
+        declared = set(id(item) for g in graph.allgraphs for item in dotparsing.flatten(g.allitems)
+                       if isinstance(item, dotparsing.DotNode))
+        graph.allitems.extend(node for node in graph.allnodes if id(node) not in declared)
+    for g in graph.allgraphs:
+        bb, lp = record['graphs'].get(g.name, (None, None))
+        if bb:
+            g.attr['bb'] = bb
+        if lp:
+            g.attr['lp'] = lp
+    if keepedges:
+        edges = {}
+        for key, values in record['edges']:
+            edges.setdefault(tuple(key), []).append(values)
+        for edge in graph.alledges:
+            values = edges.get((edge.src.name, edge.dst.name, edge.src_port, edge.dst_port))
+            if not values:
+                return False
+            for name, value in zip(PINNED_EDGE_ATTRS, values.pop(0)):
+                if value:
+                    edge.attr[name] = value
+    elif 'splines' not in graph.attr:
+        graph.attr['splines'] = 'true'
+    return True
+
+
+def parse_dot_data(dotdata, cache=None):
     """Wrapper for pydot.graph_from_dot_data
 
-    Redirects error messages to the log.
+    Redirects error messages to the log. If cache is a
+    dotparsing.DotParseCache the graph is looked up there first.
     """
-    parser = dotparsing.DotDataParser()
+    parser = cache or dotparsing.DotDataParser()
     try:
         graph = parser.parse_dot_data(dotdata)
     except dotparsing.ParseException:
         raise
     finally:
         del parser
-    log.debug('Parsed graph:\n%s', str(graph))
+    log.debug('Parsed graph:\n%s', graph)
     return graph
 
 
+# Draw operations as returned by parse_drawstring. Text operations are
+# plain lists, since do_draw_op rewrites them in place.
+DrawEllipse = namedtuple('DrawEllipse', 'op x y w h')
+DrawPoints = namedtuple('DrawPoints', 'op points')
+DrawColor = namedtuple('DrawColor', 'op color')
+DrawStyle = namedtuple('DrawStyle', 'op style')
+DrawFont = namedtuple('DrawFont', 'op size name')
+
+_drawstring_token = re.compile(r'\s*(\S+)')
+_drawstring_dash = re.compile(r'\s*-')
+
+
 def parse_drawstring(drawstring):
-    """Parse drawstring and returns a list of draw operations"""
-
-    # The draw string parser is a bit clumsy and slow
-    def doeE(c, s):
-        """Parse ellipse"""
-        # E x0 y0 w h  Filled ellipse ((x-x0)/w)^2 + ((y-y0)/h)^2 = 1
-        # e x0 y0 w h  Unfilled ellipse ((x-x0)/w)^2 + ((y-y0)/h)^2 = 1
-        tokens = s.split()[0:4]
-        if not tokens:
-            return None
-        points = [float(t) for t in tokens]
-        didx = sum(len(t) for t in tokens) + len(points) + 1
-        return didx, (c, points[0], points[1], points[2], points[3])
-
-    def doPLB(c, s):
-        """Parse polygon, polyline og B-spline"""
-        # P n x1 y1 ... xn yn  Filled polygon using the given n points
-        # p n x1 y1 ... xn yn  Unfilled polygon using the given n points
-        # L n x1 y1 ... xn yn  Polyline using the given n points
-        # B n x1 y1 ... xn yn  B-spline using the given n control points
-        # b n x1 y1 ... xn yn  Filled B-spline using the given n control points
-        tokens = s.split()
-        n = int(tokens[0])
-        points = [float(t) for t in tokens[1:n * 2 + 1]]
-        didx = sum(len(t) for t in tokens[1:n * 2 + 1]) + n * 2 + 2
-        npoints = nsplit(points, 2)
-        return didx, (c, npoints)
-
-    def doCS(c, s):
-        """Parse fill or pen color"""
-        # C n -c1c2...cn  Set fill color.
-        # c n -c1c2...cn  Set pen color.
-        # Graphviz uses the following color formats:
-        # "#%2x%2x%2x"    Red-Green-Blue (RGB)
-        #   "#%2x%2x%2x%2x" Red-Green-Blue-Alpha (RGBA)
-        #   H[, ]+S[, ]+V   Hue-Saturation-Value (HSV) 0.0 <= H,S,V <= 1.0
-        #   string  color name
-        tokens = s.split()
-        n = int(tokens[0])
-        tmp = len(tokens[0]) + 3
-        d = s[tmp:tmp + n]
-        didx = len(d) + tmp + 1
-        return didx, (c, d)
-
-    def doFont(c, s):
-        # F s n -c1c2...cn
-        # Set font. The font size is s points. The font name consists of
-        # the n characters following '-'.
-        tokens = s.split()
-        size = tokens[0]
-        n = int(tokens[1])
-        tmp = len(size) + len(tokens[1]) + 4
-        d = s[tmp:tmp + n]
-        didx = len(d) + tmp
-        return didx, (c, size, d)
-
-    def doText(c, s):
-        # T x y j w n -c1c2...cn
-        # Text drawn using the baseline point (x,y). The text consists of the
-        # n characters following '-'. The text should be left-aligned
-        # (centered, right-aligned) on the point if j is -1 (0, 1), respectively.
-        # The value w gives the width of the text as computed by the library.
-        tokens = s.split()
-        x, y, j, w = tokens[0:4]
-        n = int(tokens[4])
-        tmp = sum(len(t) for t in tokens[0:5]) + 7
-        text = s[tmp:tmp + n]
-        didx = len(text) + tmp
-        return didx, [c, x, y, j, w, text]
+    """Parse drawstring and returns a list of draw operations
 
+    Returns a (cmdlist, stat) tuple, where stat counts the operations by
+    kind. The drawstring is scanned once from left to right. Image (I) and
+    font characteristics (t) operations are counted, but not returned.
+    """
+    s = drawstring.strip().replace('\\', '')
+    match_token = _drawstring_token.match
+    match_dash = _drawstring_dash.match
     cmdlist = []
     stat = {}
-    idx = 0
-    s = drawstring.strip().replace('\\', '')
-    while idx < len(s) - 1:
-        didx = 1
-        c = s[idx]
+    pos = 0
+
+    def tokens(n):
+        nonlocal pos
+        result = []
+        for i in range(n):
+            m = match_token(s, pos)
+            result.append(m.group(1))
+            pos = m.end()
+        return result
+
+    def text():
+        # n -c1c2...cn
+        nonlocal pos
+        n = int(tokens(1)[0])
+        start = match_dash(s, pos).end()
+        pos = start + n
+        return s[start:pos]
+
+    while True:
+        m = match_token(s, pos)
+        if m is None:
+            break
+        c = m.group(1)
+        pos = m.end()
         stat[c] = stat.get(c, 0) + 1
         try:
             if c in ('e', 'E'):
-                didx, cmd = doeE(c, s[idx + 1:])
-                cmdlist.append(cmd)
+                # E x0 y0 w h  Filled ellipse ((x-x0)/w)^2 + ((y-y0)/h)^2 = 1
+                # e x0 y0 w h  Unfilled ellipse ((x-x0)/w)^2 + ((y-y0)/h)^2 = 1
+                x, y, w, h = map(float, tokens(4))
+                cmdlist.append(DrawEllipse(c, x, y, w, h))
             elif c in ('p', 'P', 'L', 'b', 'B'):
-                didx, cmd = doPLB(c, s[idx + 1:])
-                cmdlist.append(cmd)
-            elif c in ('c', 'C', 'S'):
-                didx, cmd = doCS(c, s[idx + 1:])
-                cmdlist.append(cmd)
+                # P n x1 y1 ... xn yn  Filled polygon using the given n points
+                # p n x1 y1 ... xn yn  Unfilled polygon using the given n points
+                # L n x1 y1 ... xn yn  Polyline using the given n points
+                # B n x1 y1 ... xn yn  B-spline using the given n control points
+                # b n x1 y1 ... xn yn  Filled B-spline using the given n control points
+                n = int(tokens(1)[0])
+                coords = array('d', map(float, tokens(2 * n)))
+                cmdlist.append(DrawPoints(c, list(zip(coords[::2], coords[1::2]))))
+            elif c in ('c', 'C'):
+                # C n -c1c2...cn  Set fill color.
+                # c n -c1c2...cn  Set pen color.
+                # The color is a color name, "#rrggbb[aa]", "H,S,V" or a
+                # linear "[...]" or radial "(...)" gradient.
+                cmdlist.append(DrawColor(c, text()))
+            elif c == 'S':
+                # S n -c1c2...cn  Set style attribute.
+                cmdlist.append(DrawStyle(c, text()))
             elif c == 'F':
-                didx, cmd = doFont(c, s[idx + 1:])
-                cmdlist.append(cmd)
+                # F s n -c1c2...cn
+                # Set font. The font size is s points. The font name consists of
+                # the n characters following '-'.
+                size = tokens(1)[0]
+                cmdlist.append(DrawFont(c, size, text()))
             elif c == 'T':
-                didx, cmd = doText(c, s[idx + 1:])
-                cmdlist.append(cmd)
-        except Exception as err:
+                # T x y j w n -c1c2...cn
+                # Text drawn using the baseline point (x,y). The text consists of the
+                # n characters following '-'. The text should be left-aligned
+                # (centered, right-aligned) on the point if j is -1 (0, 1), respectively.
+                # The value w gives the width of the text as computed by the library.
+                x, y, j, w = tokens(4)
+                cmdlist.append([c, x, y, j, w, text()])
+            elif c == 't':
+                # t f  Set font characteristics. f is a bit field
+                int(tokens(1)[0])
+            elif c == 'I':
+                # I x y w h n -c1c2...cn  Image
+                tokens(4)
+                text()
+            else:
+                log.debug("Unknown draw operation %s in drawstring %s", c, s)
+        except (AttributeError, ValueError) as err:
             log.debug("Failed to parse drawstring %s\n%s", s, str(err))
-
-        idx += didx
+            # continue with the next token after the operation
+            pos = m.end()
     return cmdlist, stat
 
 
+def format_xdot_number(value):
+    """Format a number the way Graphviz writes it in drawstrings"""
+    s = '%.2f' % value
+    s = s.rstrip('0').rstrip('.')
+    return s if s != '-0' else '0'
+
+
+def format_drawstring(cmdlist):
+    """Return the drawstring of a list of draw operations
+
+    The inverse of parse_drawstring.
+    """
+    fmt = format_xdot_number
+    parts = []
+    for cmd in cmdlist:
+        c = cmd[0]
+        if c in ('e', 'E'):
+            parts.append('%s %s %s %s %s' % (c, fmt(cmd[1]), fmt(cmd[2]), fmt(cmd[3]), fmt(cmd[4])))
+        elif c in ('p', 'P', 'L', 'b', 'B'):
+            points = ' '.join('%s %s' % (fmt(x), fmt(y)) for x, y in cmd[1])
+            parts.append('%s %d %s' % (c, len(cmd[1]), points))
+        elif c in ('c', 'C', 'S'):
+            parts.append('%s %d -%s' % (c, len(cmd[1]), cmd[1]))
+        elif c == 'F':
+            parts.append('F %s %d -%s' % (cmd[1], len(cmd[2]), cmd[2]))
+        elif c == 'T':
+            parts.append('T %s %s %s %s %d -%s' % (cmd[1], cmd[2], cmd[3], cmd[4], len(cmd[5]), cmd[5]))
+    return ' '.join(parts)
+
+
+class DrawOps(list):
+    """Decoded value of a draw attribute like _draw_ or _ldraw_
+
+    A list of draw operations in the form returned by parse_drawstring.
+    stat counts the operations by kind. Converting it to a string gives
+    the drawstring, so a graph with DrawOps attributes can still be
+    written as DOT.
+    """
+
+    def __init__(self, cmdlist=(), stat=None):
+        list.__init__(self, cmdlist)
+        self.stat = stat if stat is not None else {}
+
+    def operations(self):
+        """Return the draw operations. Text operations are copied, as do_draw_op changes them"""
+        return [list(cmd) if cmd[0] == 'T' else cmd for cmd in self]
+
+    def __str__(self):
+        return format_drawstring(self)
+
+
+# Many elements have the same drawstrings, and the same graph is often
+# converted to several output formats
+@lru_cache(maxsize=4096)
+def parse_draw_attr(drawstring):
+    """Parse drawstring into DrawOps. The result is shared and must not be changed"""
+    return DrawOps(*parse_drawstring(drawstring))
+
+
+def get_draw_attr(element, name):
+    """Return the draw attribute name, like _draw_ or _ldraw_, of element as DrawOps
+
+    The drawstring is parsed once and the result is cached on the element
+    until the attribute is assigned a new value. Returns an empty DrawOps
+    if the attribute is not set.
+    """
+    value = element.attr.get(name)
+    if not value:
+        return DrawOps()
+    if isinstance(value, DrawOps):
+        return value
+    cache = element._geom
+    if cache is None:
+        cache = element._geom = {}
+    else:
+        entry = cache.get(name)
+        if entry is not None and entry[0] is value:
+            return entry[1]
+    drawops = parse_draw_attr(value)
+    cache[name] = (value, drawops)
+    return drawops
+
+
+# Graphviz writes the filled B-spline as B and the unfilled as b in its JSON
+# output. It is the other way around in drawstrings.
+JSON_DRAW_OPS = {'b': 'B', 'B': 'b'}
+JSON_TEXT_ALIGN = {'l': '-1', 'c': '0', 'r': '1'}
+
+# Keys of the JSON objects that are not attributes
+JSON_KEYS = frozenset(('_gvid', '_subgraph_cnt', 'name', 'directed', 'strict', 'objects', 'subgraphs',
+                       'nodes', 'edges', 'tail', 'head'))
+
+
+def json_color(op):
+    """Return the color of a JSON c or C operation as it is written in drawstrings"""
+    grad = op.get('grad', 'none')
+    if grad == 'none':
+        return op['color']
+    fmt = format_xdot_number
+    stops = ' '.join('%s %d -%s' % (fmt(stop['frac']), len(stop['color']), stop['color'])
+                     for stop in op['stops'])
+    coords = ' '.join(fmt(v) for v in op['p0'] + op['p1'])
+    if grad == 'linear':
+        return '[%s %d %s]' % (coords, len(op['stops']), stops)
+    return '(%s %d %s)' % (coords, len(op['stops']), stops)
+
+
+def json_draw_ops(ops):
+    """Convert a list of JSON draw operations from Graphviz to DrawOps"""
+    fmt = format_xdot_number
+    cmdlist = DrawOps()
+    stat = cmdlist.stat
+    for op in ops:
+        c = op['op']
+        c = JSON_DRAW_OPS.get(c, c)
+        stat[c] = stat.get(c, 0) + 1
+        if c in ('e', 'E'):
+            x, y, w, h = op['rect']
+            cmdlist.append(DrawEllipse(c, x, y, w, h))
+        elif c in ('p', 'P', 'L', 'b', 'B'):
+            cmdlist.append(DrawPoints(c, [tuple(point) for point in op['points']]))
+        elif c in ('c', 'C'):
+            cmdlist.append(DrawColor(c, json_color(op)))
+        elif c == 'S':
+            cmdlist.append(DrawStyle(c, op['style']))
+        elif c == 'F':
+            cmdlist.append(DrawFont(c, fmt(op['size']), op['face']))
+        elif c == 'T':
+            x, y = op['pt']
+            cmdlist.append([c, fmt(x), fmt(y), JSON_TEXT_ALIGN.get(op['align'], '0'), fmt(op['width']),
+                            op['text']])
+    return cmdlist
+
+
+def json_attrs(obj):
+    """Return the attributes of a graph, node or edge in the JSON output of Graphviz"""
+    attr = {}
+    for key, value in obj.items():
+        if key in JSON_KEYS:
+            continue
+        if isinstance(value, list):
+            value = json_draw_ops(value)
+        attr[key] = value
+    return attr
+
+
+def parse_json_data(jsondata):
+    """Build a DotGraph from the JSON output of Graphviz (-Tjson)
+
+    The draw attributes are decoded directly into DrawOps, so they are
+    never parsed as drawstrings. Raises ValueError if jsondata is not
+    valid JSON.
+    """
+    data = json.loads(jsondata)
+    nsubgraphs = data.get('_subgraph_cnt', 0)
+    objects = data.get('objects', [])
+    subgraphs = dict((obj['_gvid'], obj) for obj in objects[:nsubgraphs])
+    nodes = objects[nsubgraphs:]
+    names = dict((obj['_gvid'], obj['name']) for obj in nodes)
+
+    # Subgraphs list the nodes and edges of their own subgraphs as well.
+    # They come in pre-order, so the innermost subgraph is seen last.
+    nodeowner = {}
+    edgeowner = {}
+    children = set()
+    for gvid, obj in subgraphs.items():
+        children.update(obj.get('subgraphs', ()))
+        for nodeid in obj.get('nodes', ()):
+            nodeowner[nodeid] = gvid
+        for edgeid in obj.get('edges', ()):
+            edgeowner[edgeid] = gvid
+    ownednodes = {}
+    for obj in nodes:
+        ownednodes.setdefault(nodeowner.get(obj['_gvid']), []).append(obj)
+    ownededges = {}
+    for obj in data.get('edges', ()):
+        ownededges.setdefault(edgeowner.get(obj['_gvid']), []).append(obj)
+
+    def build(graph, gvid, subgraphids):
+        # Like Graphviz, add the subgraphs before the nodes and edges
+        for subgraphid in subgraphids:
+            obj = subgraphs[subgraphid]
+            subgraph = graph.add_subgraph(obj['name'], **json_attrs(obj))
+            build(subgraph, subgraphid, obj.get('subgraphs', ()))
+            graph.allitems.append(subgraph)
+        for obj in ownednodes.get(gvid, ()):
+            graph.allitems.append(graph.add_node(obj['name'], **json_attrs(obj)))
+        for obj in ownededges.get(gvid, ()):
+            attr = json_attrs(obj)
+            srcport = attr.pop('tailport', '')
+            dstport = attr.pop('headport', '')
+            edge = graph.add_edge(names[obj['tail']], names[obj['head']],
+                                  ':' + srcport if srcport else '', ':' + dstport if dstport else '',
+                                  **attr)
+            graph.allitems.append(edge)
+
+    main_graph = dotparsing.DotGraph(data.get('name', ''), data.get('strict', False),
+                                     data.get('directed', False))
+    main_graph.attr.update(json_attrs(data))
+    build(main_graph, None, [gvid for gvid in subgraphs if gvid not in children])
+    return main_graph
+
+
+# The Graphviz directories (None for the default) of installations that can
+# not write JSON
+_graphviz_without_json = set()
+
+
 def get_graphlist(gg, l=None):
     """Traverse a graph with subgraphs and return them as a list"""
     if not l:
@@ -216,6 +1150,91 @@ def get_drawobj_lblstyle(drawobj, extra_styles=None):
     ])) or None
 
 
+# The template tags that are replaced with the drawing commands
+_body_tags = ('<<figcode>>', '<<drawcommands>>')
+_template_tag = re.compile(r'(<<[\w.]+>>)')
+_codeonly_section = re.compile('<<startcodeonlysection>>(.*?)<<endcodeonlysection>>',
+                               re.DOTALL | re.MULTILINE)
+_figonly_sections = (
+    re.compile('<<start_figonlysection>>(.*?)<<end_figonlysection>>', re.DOTALL | re.MULTILINE),
+    re.compile('<<startfigonlysection>>(.*?)<<endfigonlysection>>', re.DOTALL | re.MULTILINE),
+)
+_removed_sections = {
+    'preproc': re.compile('<<startoutputsection>>.*?<<endoutputsection>>', re.DOTALL | re.MULTILINE),
+    'output': re.compile('<<startpreprocsection>>.*?<<endpreprocsection>>', re.DOTALL | re.MULTILINE),
+}
+_unused_sections = (
+    re.compile('<<start_figonlysection>>.*?<<end_figonlysection>>', re.DOTALL | re.MULTILINE),
+    re.compile('<<startcodeonlysection>>.*?<<endcodeonlysection>>', re.DOTALL | re.MULTILINE),
+)
+
+
+def select_template_sections(template, mode):
+    """Return the part of template that is used in mode
+
+    mode is 'codeonly', 'figonly', 'preproc' or 'output'. Templates without
+    a codeonly or figonly section use the output sections in those modes.
+    """
+    if mode == 'codeonly':
+        m = _codeonly_section.search(template)
+        if m:
+            return m.group(1).strip()
+    elif mode == 'figonly':
+        for r in _figonly_sections:
+            m = r.search(template)
+            if m:
+                return m.group(1)
+    for r in _unused_sections:
+        template = r.sub('', template)
+    return _removed_sections['preproc' if mode == 'preproc' else 'output'].sub('', template)
+
+
+@lru_cache(maxsize=64)
+def compile_template(template, mode):
+    """Split the part of template used in mode into text and tags
+
+    Returns a tuple where the items with odd indices are the tags.
+    """
+    return tuple(_template_tag.split(select_template_sections(template, mode)))
+
+
+def iter_template(segments, tags):
+    """Yield the text of a compiled template with the tags replaced
+
+    Each tag is replaced once with its value in tags, so tags in the values
+    are not expanded. Tags missing from tags are kept.
+    """
+    for i, segment in enumerate(segments):
+        if i % 2:
+            segment = tags.get(segment, segment)
+        if segment:
+            yield segment
+
+
+def strip_chunks(chunks):
+    """Yield chunks with the whitespace at the start and end of their concatenation removed
+
+    >>> list(strip_chunks([' ', ' a ', 'b\\n', ' ']))
+    ['a', ' ', 'b']
+    """
+    started = False
+    pending = ''
+    for chunk in chunks:
+        if not started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            started = True
+        stripped = chunk.rstrip()
+        if stripped:
+            if pending:
+                yield pending
+            yield stripped
+            pending = chunk[len(stripped):]
+        else:
+            pending += chunk
+
+
 class DotConvBase(object):
     """Dot2TeX converter base"""
 
@@ -228,7 +1247,10 @@ class DotConvBase(object):
             self.template = options.get('template', '')
         self.textencoding = options.get('encoding', DEFAULT_TEXTENCODING)
         self.templatevars = {}
-        self.body = ""
+        # the drawing commands emitted so far, see emit()
+        self.fragments = []
+        # (level, message) diagnostics from the last Graphviz run
+        self.graphviz_messages = []
         if options.get('templatefile', ''):
             self.load_template(options['templatefile'])
         if options.get('template', ''):
@@ -251,6 +1273,20 @@ class DotConvBase(object):
         """Load dot file and convert"""
         pass
 
+    def emit(self, code):
+        """Add code to the drawing commands of the figure"""
+        if code:
+            self.fragments.append(code)
+
+    @property
+    def body(self):
+        """The drawing commands emitted so far as a string"""
+        return ''.join(self.fragments)
+
+    @body.setter
+    def body(self, code):
+        self.fragments = [code] if code else []
+
     def start_fig(self):
         return ""
 
@@ -356,11 +1392,32 @@ class DotConvBase(object):
     def do_drawstring(self, drawstring, drawobj, texlbl_name="texlbl", use_drawstring_pos=False):
         """Parse and draw drawsting
 
-        Just a wrapper around do_draw_op.
+        Just a wrapper around do_draw_op. drawstring can also be DrawOps.
         """
-        drawoperations, stat = parse_drawstring(drawstring)
+        if isinstance(drawstring, DrawOps):
+            drawoperations, stat = drawstring.operations(), drawstring.stat
+        else:
+            drawoperations, stat = parse_drawstring(drawstring)
         return self.do_draw_op(drawoperations, drawobj, stat, texlbl_name, use_drawstring_pos)
 
+    def get_draw_ops(self, drawobj, names):
+        """Return the draw operations of the draw attributes names of drawobj
+
+        Returns a (drawoperations, stat) tuple, or None if none of the
+        attributes are set.
+        """
+        values = [drawobj.attr.get(name, "") for name in names]
+        if not any(value.strip() if isinstance(value, str) else value for value in values):
+            return None
+        drawoperations = []
+        stat = {}
+        for name in names:
+            drawops = get_draw_attr(drawobj, name)
+            drawoperations.extend(drawops.operations())
+            for c, n in drawops.stat.items():
+                stat[c] = stat.get(c, 0) + n
+        return drawoperations, stat
+
     def do_draw_op(self, drawoperations, drawobj, stat, texlbl_name="texlbl", use_drawstring_pos=False):
         """Execute the operations in drawoperations"""
         s = ""
@@ -425,53 +1482,42 @@ class DotConvBase(object):
                     drawop[3] = '0'
                     if not use_drawstring_pos:
                         if texlbl_name == "tailtexlbl":
-                            pos = drawobj.attr.get('tail_lp') or \
-                                  drawobj.attr.get('pos')
+                            lpname = 'tail_lp'
                         elif texlbl_name == "headtexlbl":
-                            pos = drawobj.attr.get('head_lp') or \
-                                  drawobj.attr.get('pos')
+                            lpname = 'head_lp'
+                        else:
+                            lpname = 'lp'
+                        if drawobj.attr.get(lpname):
+                            pos = dotparsing.get_geometry(drawobj, lpname)
+                        elif isinstance(drawobj, dotparsing.DotEdge):
+                            # the pos of an edge is a spline, not a point
+                            pos = None
                         else:
-                            pos = drawobj.attr.get('lp') or \
-                                  drawobj.attr.get('pos')
+                            pos = dotparsing.get_geometry(drawobj, 'pos')
 
                         if pos:
-                            coord = pos.split(',')
-                            if len(coord) == 2:
-                                drawop[1] = coord[0]
-                                drawop[2] = coord[1]
-                            pass
+                            drawop[1], drawop[2] = pos
 
                 lblstyle = get_drawobj_lblstyle(drawobj, extra_styles=drawobj.attr.get('exstyle'))
                 s += self.draw_text(drawop, lblstyle)
         return s
 
     def do_nodes(self):
-        s = ""
         for node in self.nodes:
             self.currentnode = node
-            general_draw_string = node.attr.get('_draw_', "")
-            label_string = node.attr.get('_ldraw_', "")
-
-            drawstring = general_draw_string + " " + label_string
-
-            if not drawstring.strip():
+            drawops = self.get_draw_ops(node, ('_draw_', '_ldraw_'))
+            if drawops is None:
                 continue
             # detect node type
             shape = node.attr.get('shape', '')
             if not shape:
                 shape = 'ellipse'  # default
-                # extract size information
-            x, y = node.attr.get('pos', '').split(',')
 
-            # width and height are in inches. Convert to bp units
-            # w = float(node.attr['width']) * INCH2BP
-            # h = float(node.attr['height']) * INCH2BP
-
-            s += self.output_node_comment(node)
+            s = self.output_node_comment(node)
             s += self.start_node(node)
-            s += self.do_drawstring(drawstring, node)
+            s += self.do_draw_op(drawops[0], node, drawops[1])
             s += self.end_node(node)
-        self.body += s
+            self.emit(s)
 
     def get_edge_points(self, edge):
         # edge BNF
@@ -486,37 +1532,21 @@ class DotConvBase(object):
         ##and endp  =   "e,%d,%d"
         ##and startp    =   "s,%d,%d"
         ##If a spline has points p1 p2 p3 ... pn, (n = 1 (mod 3)), the points correspond to the control points of a B-spline from p1 to pn. If startp is given, it touches one node of the edge, and the arrowhead goes from p1 to startp. If startp is not given, p1 touches a node. Similarly for pn and endp.
-        pos = edge.attr.get('pos')
-        if pos:
-            segments = pos.split(';')
-        else:
+        splines = dotparsing.get_geometry(edge, 'pos')
+        if not splines:
             return []
 
         return_segments = []
-        for pos in segments:
-            points = pos.split(' ')
+        for startp, endp, coords in splines:
+            points = list(zip(coords[::2], coords[1::2]))
             # check direction
             arrow_style = '--'
-            i = 0
-            if points[i].startswith('s'):
-                p = points[0].split(',')
-                tmp = "%s,%s" % (p[1], p[2])
-                if points[1].startswith('e'):
-                    points[2] = tmp
-                else:
-                    points[1] = tmp
-                del points[0]
+            if startp:
+                points[0] = startp
                 arrow_style = '<-'
-                i += 1
-            if points[0].startswith('e'):
-                p = points[0].split(',')
-                points.pop()
-                points.append("%s,%s" % (p[1], p[2]))
-                del points[0]
-                arrow_style = '->'
-                i += 1
-            if i > 1:
-                arrow_style = '<->'
+            if endp:
+                points[-1] = endp
+                arrow_style = '<->' if startp else '->'
 
             arrow_style = self.get_output_arrow_styles(arrow_style, edge)
 
@@ -525,24 +1555,19 @@ class DotConvBase(object):
         return return_segments
 
     def do_edges(self):
-        s = ""
-        s += self.set_color(('cC', "black"))
+        self.emit(self.set_color(('cC', "black")))
         for edge in self.edges:
-            general_draw_string = edge.attr.get('_draw_', "")
-            label_string = edge.attr.get('_ldraw_', "")
-            head_arrow_string = edge.attr.get('_hdraw_', "")
-            tail_arrow_string = edge.attr.get('_tdraw_', "")
-            tail_label_string = edge.attr.get('_tldraw_', "")
-            head_label_string = edge.attr.get('_hldraw_', "")
+            label_string = get_draw_attr(edge, '_ldraw_')
+            tail_label_string = get_draw_attr(edge, '_tldraw_')
+            head_label_string = get_draw_attr(edge, '_hldraw_')
 
             # Note that the order of the draw strings should be the same
             # as in the xdot output.
-            drawstring = general_draw_string + " " + head_arrow_string + " " + tail_arrow_string \
-                         + " " + label_string
-            drawop, stat = parse_drawstring(drawstring)
-            if not drawstring.strip():
+            drawops = self.get_draw_ops(edge, ('_draw_', '_hdraw_', '_tdraw_', '_ldraw_'))
+            if drawops is None:
                 continue
-            s += self.output_edge_comment(edge)
+            drawop, stat = drawops
+            s = self.output_edge_comment(edge)
             if self.options.get('duplicate'):
                 s += self.start_edge()
                 s += self.do_draw_op(drawop, edge, stat)
@@ -554,26 +1579,28 @@ class DotConvBase(object):
                 s += self.do_drawstring(label_string, edge)
                 s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
                 s += self.do_drawstring(head_label_string, edge, "headtexlbl")
-        self.body += s
+            self.emit(s)
 
     def do_graph(self):
-        general_draw_string = self.graph.attr.get('_draw_', "")
-        label_string = self.graph.attr.get('_ldraw_', "")
-        # Avoid filling background of graphs with white
-        if general_draw_string.startswith('c 5 -white C 5 -white') \
-                and not self.graph.attr.get('style'):
-            general_draw_string = ''
-        if getattr(self.graph, '_draw_', None):
+        general_draw_ops = get_draw_attr(self.graph, '_draw_')
+        label_ops = get_draw_attr(self.graph, '_ldraw_')
+        drawoperations = []
+        if general_draw_ops:
             # bug
-            general_draw_string = "c 5 -black " + general_draw_string  # self.graph._draw_
-            pass
-        drawstring = general_draw_string + " " + label_string
-        if drawstring.strip():
+            drawoperations.append(DrawColor('c', 'black'))
+            # Avoid filling background of graphs with white
+            if general_draw_ops[:2] != [('c', 'white'), ('C', 'white')] or self.graph.attr.get('style'):
+                drawoperations.extend(general_draw_ops.operations())
+        drawoperations.extend(label_ops.operations())
+        if drawoperations:
+            stat = {}
+            for drawop in drawoperations:
+                stat[drawop[0]] = stat.get(drawop[0], 0) + 1
             s = self.start_graph(self.graph)
-            g = self.do_drawstring(drawstring, self.graph)
+            g = self.do_draw_op(drawoperations, self.graph, stat)
             e = self.end_graph(self.graph)
             if g.strip():
-                self.body += s + g + e
+                self.emit(s + g + e)
 
     def set_options(self):
         # process options
@@ -587,26 +1614,142 @@ class DotConvBase(object):
         self.options['valignmode'] = getattr(self.main_graph, 'd2tvalignmode', '') \
                                      or self.options.get('valignmode', 'center')
 
-    def convert(self, dotdata):
+    def get_parse_cache(self):
+        """Return the parse cache selected by the options, or None"""
+        cachedir = self.options.get('parsecachedir')
+        if not (cachedir or self.options.get('parsecache')):
+            return None
+        return dotparsing.get_shared_cache(dotparsing.DotParseCache,
+                                           cachedir=cachedir or dotparsing.user_cache_path('parse'))
+
+    def get_layout_cache(self):
+        """Return the layout cache selected by the options, or None"""
+        if self.options.get('nolayoutcache'):
+            return None
+        cachedir = self.options.get('layoutcachedir')
+        if not cachedir and self.options.get('layoutcache'):
+            cachedir = dotparsing.user_cache_path('layout')
+        return dotparsing.get_shared_cache(LayoutCache, cachedir=cachedir)
+
+    def run_layout(self, dotdata, output_format, prog=None, options=None):
+        """Lay out dotdata with Graphviz and return the output, or None
+
+        prog and options default to the prog and progoptions options.
+        """
+        cache = self.get_layout_cache()
+        layout = cache.run_graphviz if cache is not None else run_graphviz
+        data, self.graphviz_messages = layout(
+            dotdata, prog or self.options.get('prog', 'dot'),
+            options=self.options.get('progoptions', '') if options is None else options,
+            graphvizdir=self.options.get('graphvizdir'),
+            output_format=output_format,
+            timeout=self.options.get('progtimeout'),
+            workers=self.options.get('graphvizworkers'),
+            gvbinding=not self.options.get('nogvbinding'))
+        return data
+
+    def layout_json(self, dotdata, prog=None, options=None):
+        """Lay out dotdata with Graphviz and build the graph from its JSON output
+
+        Returns None if this version of Graphviz can not write JSON. The
+        caller then falls back to xdot output.
+        """
+        graphvizdir = self.options.get('graphvizdir')
+        if graphvizdir in _graphviz_without_json:
+            return None
+        log.info('Trying to create JSON layout data')
+        jsondata = self.run_layout(dotdata, 'json', prog, options)
+        if jsondata is None:
+            if any('not recognized' in message for level, message in self.graphviz_messages):
+                log.info('Graphviz does not support JSON output')
+                _graphviz_without_json.add(graphvizdir)
+                return None
+            log.error('Failed to lay out the graph. Is Graphviz installed?')
+            sys.exit(1)
+        try:
+            return parse_json_data(jsondata)
+        except (ValueError, KeyError, TypeError) as err:
+            log.warning('Could not read the JSON output of Graphviz: %s', err)
+            return None
+
+    def layout(self, dotdata, parsecache=None, prog=None, options=None):
+        """Lay out dotdata with Graphviz and return the laid out graph
+
+        The layout is read from the xdot output of Graphviz, or with the
+        jsonlayout option from its JSON output if Graphviz can write JSON.
+        """
+        graph = None
+        if self.options.get('jsonlayout'):
+            graph = self.layout_json(dotdata, prog, options)
+        if graph is None:
+            log.info('Trying to create xdotdata')
+            tmpdata = self.run_layout(dotdata, 'xdot', prog, options)
+            if tmpdata is None or not tmpdata.strip():
+                log.error('Failed to create xdotdata. Is Graphviz installed?')
+                sys.exit(1)
+            log.debug('xdotdata:\n' + str(tmpdata))
+            graph = parse_dot_data(tmpdata, parsecache)
+        return graph
+
+    def get_layout_key(self, graph):
+        """Return the key of the pinned layout of graph in the layout cache, or None"""
+        version = dotparsing.get_graphviz_version(self.options.get('graphvizdir'))
+        if version is None:
+            return None
+        return layout_structure_key(graph, self.options.get('prog', 'dot'),
+                                    self.options.get('progoptions', ''), version)
+
+    def reuse_layout(self, dotdata, cache, key, parsecache=None):
+        """Lay out dotdata with the node positions of an earlier graph with the same structure
+
+        Graphviz is only run with the positions pinned (neato -n), which is
+        much faster than a full layout. If no label can have changed size,
+        the edges are kept as well (neato -n2). Returns None if there is no
+        earlier layout.
+        """
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        record = entry[0]
+        graph = parse_dot_data(dotdata, parsecache)
+        keepedges = record['labels'] == layout_label_key(graph)
+        if not pin_layout(graph, record, keepedges):
+            return None
+        log.info('Reusing the layout of an earlier version of the graph')
+        options = '%s %s' % (self.options.get('progoptions', ''), '-n2' if keepedges else '-n')
+        return self.layout(dotparsing.dot_string(graph), parsecache, 'neato', options.strip())
+
+    def load_graph(self, dotdata):
+        """Parse and if needed lay out dot data or an already parsed DotGraph"""
         # parse data processed by dot.
         log.debug('Start conversion')
-        main_graph = parse_dot_data(dotdata)
+        parsecache = self.get_parse_cache()
+        if isinstance(dotdata, dotparsing.DotGraph):
+            main_graph = dotdata
+            dotdata = None
+        else:
+            main_graph = parse_dot_data(dotdata, parsecache)
 
         if not self.dopreproc and not hasattr(main_graph, 'xdotversion'):
+            if dotdata is None:
+                dotdata = dotparsing.dot_string(main_graph)
             # Older versions of Graphviz does not include the xdotversion
             # attribute
             if not (dotdata.find('_draw_') > 0 or dotdata.find('_ldraw_') > 0):
                 # need to convert to xdot format
                 # Warning. Pydot will not include custom attributes
-                log.info('Trying to create xdotdata')
-
-                tmpdata = create_xdot(dotdata, self.options.get('prog', 'dot'),
-                                      options=self.options.get('progoptions', ''))
-                if tmpdata is None or not tmpdata.strip():
-                    log.error('Failed to create xdotdata. Is Graphviz installed?')
-                    sys.exit(1)
-                log.debug('xdotdata:\n' + str(tmpdata))
-                main_graph = parse_dot_data(tmpdata)
+                cache = self.get_layout_cache()
+                layoutkey = None
+                if self.options.get('reuselayout') and cache is not None:
+                    layoutkey = self.get_layout_key(main_graph)
+                if layoutkey is not None:
+                    laid_out = self.reuse_layout(dotdata, cache, layoutkey, parsecache)
+                    if laid_out is None:
+                        laid_out = self.layout(dotdata, parsecache)
+                    cache.put(layoutkey, get_pinned_layout(main_graph, laid_out))
+                    main_graph = laid_out
+                else:
+                    main_graph = self.layout(dotdata, parsecache)
                 log.debug('dotparsing graph:\n' + str(main_graph))
             else:
                 # old version
@@ -619,9 +1762,13 @@ class DotConvBase(object):
         # Detect graph type
         self.directedgraph = main_graph.directed
 
-        if self.dopreproc:
-            return self.do_preview_preproc()
+    def iter_figure(self):
+        """Emit the drawing commands of the figure
 
+        Yields after the start of the figure, each graph, the nodes, the
+        edges and the end of the figure have been emitted.
+        """
+        main_graph = self.main_graph
         # Remove annoying square
         # Todo: Remove squares from subgraphs. See pgram.dot
         dstring = self.main_graph.attr.get('_draw_', "")
@@ -633,7 +1780,8 @@ class DotConvBase(object):
         # A graph can consists of nested graph. Extract all graphs
         graphlist = get_graphlist(self.main_graph, [])
 
-        self.body += self.start_fig()
+        self.emit(self.start_fig())
+        yield
 
         # To get correct drawing order we need to iterate over the graphs
         # multiple times. First we draw the graph graphics, then nodes and
@@ -643,69 +1791,111 @@ class DotConvBase(object):
         for graph in graphlist:
             self.graph = graph
             self.do_graph()
+            yield
 
         if True:
             self.nodes = list(main_graph.allnodes)
             self.edges = list(main_graph.alledges)
             if not self.options.get('switchdraworder'):
                 self.do_edges()  # tmp
+                yield
                 self.do_nodes()
+                yield
             else:
                 self.do_nodes()
+                yield
                 self.do_edges()
+                yield
+
+        self.emit(self.end_fig())
+        yield
 
-        self.body += self.end_fig()
+    def iter_body(self, keep=False):
+        """Emit the drawing commands and yield them as they are generated
+
+        The yielded code is removed from the fragments unless keep is true.
+        """
+        done = 0
+        for step in self.iter_figure():
+            fragments = self.fragments
+            for code in fragments[done:]:
+                yield code
+            if keep:
+                done = len(fragments)
+            else:
+                self.fragments = []
+
+    def convert(self, dotdata):
+        """Convert dot data or an already parsed DotGraph"""
+        self.load_graph(dotdata)
+        if self.dopreproc:
+            return self.do_preview_preproc()
+        for step in self.iter_figure():
+            pass
         return self.output()
 
-    def clean_template(self, template):
-        """Remove preprocsection or outputsection"""
-        if not self.dopreproc and self.options.get('codeonly'):
-            r = re.compile('<<startcodeonlysection>>(.*?)<<endcodeonlysection>>',
-                           re.DOTALL | re.MULTILINE)
-            m = r.search(template)
-            if m:
-                return m.group(1).strip()
-        if not self.dopreproc and self.options.get('figonly'):
-            r = re.compile('<<start_figonlysection>>(.*?)<<end_figonlysection>>',
-                           re.DOTALL | re.MULTILINE)
-            m = r.search(template)
-            if m:
-                return m.group(1)
-            r = re.compile('<<startfigonlysection>>(.*?)<<endfigonlysection>>',
-                           re.DOTALL | re.MULTILINE)
-            m = r.search(template)
-            if m:
-                return m.group(1)
+    def convert_iter(self, dotdata):
+        """Convert like convert(), but yield the output in chunks
 
+        The template before the drawing commands is yielded first, then the
+        drawing commands as they are generated, and finally the rest of
+        the template, so that the output can be written without holding it
+        all in memory. With preprocessing, or if the converter has its own
+        output(), the result is yielded as a single chunk.
+        """
+        self.load_graph(dotdata)
         if self.dopreproc:
-            r = re.compile('<<startoutputsection>>.*?<<endoutputsection>>',
-                           re.DOTALL | re.MULTILINE)
-        else:
-            r = re.compile('<<startpreprocsection>>.*?<<endpreprocsection>>',
-                           re.DOTALL | re.MULTILINE)
-            # remove codeonly and figonly section
-        r2 = re.compile('<<start_figonlysection>>.*?<<end_figonlysection>>',
-                        re.DOTALL | re.MULTILINE)
-        tmp = r2.sub('', template)
-        r2 = re.compile('<<startcodeonlysection>>.*?<<endcodeonlysection>>',
-                        re.DOTALL | re.MULTILINE)
-        tmp = r2.sub('', tmp)
-        return r.sub('', tmp)
+            yield self.do_preview_preproc()
+            return
+        if type(self).output is not DotConvBase.output:
+            for step in self.iter_figure():
+                pass
+            yield self.output()
+            return
+        self.init_template_vars()
+        segments = compile_template(self.template, self.template_mode())
+        # the drawing commands must be kept if they appear more than once
+        repeated = sum(tag in _body_tags for tag in segments[1::2]) > 1
+        streamed = False
+        for i, segment in enumerate(segments):
+            if i % 2 == 0 or segment not in _body_tags:
+                if i % 2:
+                    segment = self.templatevars.get(segment, segment)
+                if segment:
+                    yield segment
+            elif not streamed:
+                streamed = True
+                for code in strip_chunks(self.iter_body(keep=repeated)):
+                    yield code
+            else:
+                yield self.body.strip()
+
+    def template_mode(self):
+        """Return the mode the template is used in, see select_template_sections()"""
+        if self.dopreproc:
+            return 'preproc'
+        if self.options.get('codeonly'):
+            return 'codeonly'
+        if self.options.get('figonly'):
+            return 'figonly'
+        return 'output'
+
+    def clean_template(self, template):
+        """Remove preprocsection or outputsection"""
+        return select_template_sections(template, self.template_mode())
 
     def init_template_vars(self):
         variables = {}
         # get bounding box
-        bbstr = self.main_graph.attr.get('bb', '')
-        if bbstr:
-            bb = bbstr.split(',')
+        bb = dotparsing.get_geometry(self.main_graph, 'bb')
+        if bb:
             variables['<<bbox>>'] = "(%sbp,%sbp)(%sbp,%sbp)\n" % (
                 smart_float(bb[0]), smart_float(bb[1]), smart_float(bb[2]), smart_float(bb[3]))
-            variables['<<bbox.x0>>'] = bb[0]
-            variables['<<bbox.y0>>'] = bb[1]
-            variables['<<bbox.x1>>'] = bb[2]
-            variables['<<bbox.y1>>'] = bb[3]
-        variables['<<figcode>>'] = self.body.strip()
-        variables['<<drawcommands>>'] = self.body.strip()
+            variables['<<bbox.x0>>'] = str(bb[0])
+            variables['<<bbox.y0>>'] = str(bb[1])
+            variables['<<bbox.x1>>'] = str(bb[2])
+            variables['<<bbox.y1>>'] = str(bb[3])
+        variables['<<figcode>>'] = variables['<<drawcommands>>'] = self.body.strip()
         variables['<<textencoding>>'] = self.textencoding
         docpreamble = (self.options.get('docpreamble', '')
                        or getattr(self.main_graph, 'd2tdocpreamble', ''))
@@ -727,10 +1917,8 @@ class DotConvBase(object):
 
     def output(self):
         self.init_template_vars()
-        template = self.clean_template(self.template)
-        code = replace_tags(template, self.templatevars,
-                            self.templatevars)
-        return code
+        segments = compile_template(self.template, self.template_mode())
+        return ''.join(iter_template(segments, self.templatevars))
 
     def get_label(self, drawobj, label_attribute="label", tex_label_attribute="texlbl"):
         text = ""
@@ -801,10 +1989,8 @@ class DotConvBase(object):
     def do_preview_preproc(self):
         # setDotAttr(self.maingraph)
         self.init_template_vars()
-        template = self.clean_template(self.template)
-        template = replace_tags(template, self.templatevars,
-                                self.templatevars)
-        pp = TeXDimProc(template, self.options)
+        segments = compile_template(self.template, self.template_mode())
+        pp = TeXDimProc(''.join(iter_template(segments, self.templatevars)), self.options)
         usednodes = {}
         usededges = {}
         usedgraphs = {}
@@ -900,8 +2086,12 @@ To see what happened, run dot2tex with the --debug option.
 
             xmargin, ymargin = self.get_margins(node)
             ht = hp + dp
-            minwidth = float(item.attr.get('width') or DEFAULT_NODE_WIDTH)
-            minheight = float(item.attr.get('height') or DEFAULT_NODE_HEIGHT)
+            minwidth = dotparsing.get_geometry(item, 'width')
+            if minwidth is None:
+                minwidth = DEFAULT_NODE_WIDTH
+            minheight = dotparsing.get_geometry(item, 'height')
+            if minheight is None:
+                minheight = DEFAULT_NODE_HEIGHT
             if self.options.get('nominsize'):
                 width = wt + 2 * xmargin
                 height = ht + 2 * ymargin
@@ -958,7 +2148,9 @@ To see what happened, run dot2tex with the --debug option.
 
         self.main_graph.attr['d2toutputformat'] = self.options.get('format',
                                                                    DEFAULT_OUTPUT_FORMAT)
-        graphcode = str(self.main_graph)
+        fp = io.StringIO()
+        self.main_graph.write(fp)
+        graphcode = fp.getvalue()
         graphcode = graphcode.replace('<<<', '<<')
         graphcode = graphcode.replace('>>>', '>>')
         return graphcode
@@ -977,6 +2169,291 @@ dimext = r"""
 \((?P<ht>\d*)\+(?P<dp>\d*)x(?P<wd>\d*)\)"""
 
 
+TEXDIM_CACHE_VERSION = 1
+
+# The smallest number of snippets measured by each TeX process. Starting
+# TeX and loading the preamble takes longer than measuring a few snippets,
+# so small sets are measured by a single process.
+TEX_SHARD_MIN_SNIPPETS = 50
+
+
+class TeXDimCache(object):
+    """Cache of the (height, depth, width) of TeX snippets in inches
+
+    Entries are keyed by the code of a snippet and a context hash of the
+    TeX engine and the preprocessing template, which includes the document
+    preamble. The most recently used entries are kept in memory and, if
+    filename is given, all entries in an SQLite database. When the database
+    holds more than maxdiskentries the least recently used are removed.
+    """
+
+    def __init__(self, filename=None, maxentries=100000, maxdiskentries=1000000):
+        self.filename = filename
+        self.maxentries = maxentries
+        self.maxdiskentries = maxdiskentries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def context(self, template, engine):
+        """Return the hash of everything apart from the snippet that affects its size"""
+        m = hashlib.sha256(('%s\0%s\0' % (TEXDIM_CACHE_VERSION, engine)).encode('utf8'))
+        m.update(template.encode('utf8', 'surrogateescape'))
+        return m.hexdigest()
+
+    def get_many(self, context, codes):
+        """Return a dictionary with the cached dimensions of the snippets in codes"""
+        found = {}
+        missing = []
+        with self._lock:
+            for code in codes:
+                dims = self._entries.get((context, code))
+                if dims is None:
+                    missing.append(code)
+                else:
+                    self._entries.move_to_end((context, code))
+                    found[code] = dims
+        if missing and self.filename:
+            loaded = self._load(context, missing)
+            self._remember(context, loaded)
+            found.update(loaded)
+        return found
+
+    def put_many(self, context, dims):
+        """Store a dictionary of snippet dimensions"""
+        self._remember(context, dims)
+        if self.filename:
+            self._store(context, dims)
+
+    def clear(self):
+        """Empty the in-memory tier"""
+        with self._lock:
+            self._entries.clear()
+
+    def _remember(self, context, dims):
+        with self._lock:
+            for code, value in dims.items():
+                self._entries[(context, code)] = value
+                self._entries.move_to_end((context, code))
+            while len(self._entries) > self.maxentries:
+                self._entries.popitem(last=False)
+
+    def _connect(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        db = sqlite3.connect(self.filename, timeout=30)
+        db.execute('CREATE TABLE IF NOT EXISTS texdims (context TEXT, code TEXT, '
+                   'height REAL, depth REAL, width REAL, used REAL, '
+                   'PRIMARY KEY (context, code))')
+        return db
+
+    def _load(self, context, codes):
+        found = {}
+        now = time.time()
+        try:
+            db = self._connect()
+            try:
+                with db:
+                    # stay below the SQLite limit on the number of parameters
+                    for part in chunks(codes, 500):
+                        query = ('SELECT code, height, depth, width FROM texdims '
+                                 'WHERE context = ? AND code IN (%s)' % ','.join('?' * len(part)))
+                        for code, height, depth, width in db.execute(query, [context] + part):
+                            found[code] = (height, depth, width)
+                    db.executemany('UPDATE texdims SET used = ? WHERE context = ? AND code = ?',
+                                   [(now, context, code) for code in found])
+            finally:
+                db.close()
+        except (sqlite3.Error, OSError) as err:
+            log.warning('Failed to read the TeX dimension cache %s: %s', self.filename, err)
+        return found
+
+    def _store(self, context, dims):
+        now = time.time()
+        try:
+            db = self._connect()
+            try:
+                with db:
+                    db.executemany('INSERT OR REPLACE INTO texdims VALUES (?, ?, ?, ?, ?, ?)',
+                                   [(context, code) + tuple(value) + (now,)
+                                    for code, value in dims.items()])
+                    count = db.execute('SELECT COUNT(*) FROM texdims').fetchone()[0]
+                    if count > self.maxdiskentries:
+                        db.execute('DELETE FROM texdims WHERE rowid IN '
+                                   '(SELECT rowid FROM texdims ORDER BY used LIMIT ?)',
+                                   (count - self.maxdiskentries,))
+            finally:
+                db.close()
+        except (sqlite3.Error, OSError) as err:
+            log.warning('Failed to write the TeX dimension cache %s: %s', self.filename, err)
+
+
+TEX_FORMAT_VERSION = 1
+
+
+class TeXFormatCache(object):
+    """Cache of TeX formats with a dumped document preamble
+
+    Loading a format is much faster than running the preamble, which for
+    TikZ loads hundreds of files. A format is dumped in cachedir for each
+    engine and preamble. The files TeX read while dumping it are recorded,
+    and the format is dumped again when any of them or the engine changes.
+    Only the maxformats most recently used formats are kept.
+    """
+
+    def __init__(self, cachedir, maxformats=8):
+        self.cachedir = cachedir
+        self.maxformats = maxformats
+        self._lock = threading.Lock()
+        # keys of formats that could not be dumped in this process
+        self._failed = set()
+
+    def key(self, engine, preamble):
+        """Return the name of the format for preamble"""
+        m = hashlib.sha256(('%s\0%s\0' % (TEX_FORMAT_VERSION, engine)).encode('utf8'))
+        m.update(preamble.encode('utf8', 'surrogateescape'))
+        return 'dot2tex-' + m.hexdigest()[:32]
+
+    def get(self, engine, preamble):
+        """Return the name of an up to date format for preamble, or None
+
+        The format is dumped if needed. It is found by TeX when cachedir is
+        added to the TEXFORMATS environment variable, see environ().
+        """
+        key = self.key(engine, preamble)
+        with self._lock:
+            if key in self._failed:
+                return None
+            if self._is_current(key, engine):
+                try:
+                    # the modification time orders the formats for eviction
+                    os.utime(os.path.join(self.cachedir, key + '.json'), None)
+                except OSError:
+                    pass
+                return key
+            if self._dump(key, engine, preamble):
+                self.prune()
+                return key
+            self._failed.add(key)
+            return None
+
+    def discard(self, key):
+        """Stop using a format that does not work"""
+        with self._lock:
+            self._failed.add(key)
+        for ext in ('.json', '.fmt'):
+            try:
+                os.remove(os.path.join(self.cachedir, key + ext))
+            except OSError:
+                pass
+
+    def prune(self):
+        """Remove the least recently used formats until at most maxformats are left"""
+        try:
+            names = os.listdir(self.cachedir)
+        except OSError:
+            return
+        records = []
+        for name in names:
+            if name.endswith('.json'):
+                try:
+                    records.append((os.stat(os.path.join(self.cachedir, name)).st_mtime, name[:-5]))
+                except OSError:
+                    continue
+        records.sort(reverse=True)
+        for mtime, key in records[self.maxformats:]:
+            for ext in ('.json', '.fmt'):
+                try:
+                    os.remove(os.path.join(self.cachedir, key + ext))
+                except OSError:
+                    pass
+
+    def environ(self):
+        """Return the environment for running TeX with the formats in cachedir"""
+        env = dict(os.environ)
+        # the empty entry at the end keeps the default search path
+        env['TEXFORMATS'] = self.cachedir + os.pathsep + env.get('TEXFORMATS', '')
+        return env
+
+    def _inputs_state(self, inputs):
+        state = {}
+        for path in inputs:
+            try:
+                st = os.stat(path)
+            except OSError:
+                state[path] = None
+            else:
+                state[path] = [st.st_mtime, st.st_size]
+        return state
+
+    def _engine_state(self, engine):
+        path = shutil.which(engine)
+        if path is None:
+            return None
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        return [path, st.st_mtime, st.st_size]
+
+    def _is_current(self, key, engine):
+        try:
+            with open(os.path.join(self.cachedir, key + '.json')) as f:
+                record = json.load(f)
+            if not os.path.isfile(os.path.join(self.cachedir, key + '.fmt')):
+                return False
+            return (record['engine'] == self._engine_state(engine)
+                    and record['inputs'] == self._inputs_state(record['inputs']))
+        except (ValueError, KeyError, TypeError, OSError):
+            return False
+
+    def _dump(self, key, engine, preamble):
+        log.info('Dumping a TeX format for the preamble')
+        tempdir = tempfile.mkdtemp(prefix='dot2tex')
+        try:
+            texfilename = os.path.join(tempdir, key + '.tex')
+            with open(texfilename, 'w') as f:
+                f.write(preamble + '\n\\dump\n')
+            args = [engine, '-ini', '-interaction=nonstopmode', '-recorder', '-jobname=' + key,
+                    '-output-directory=' + tempdir, '&' + engine, texfilename]
+            log.debug('Running command: %s' % ' '.join(args))
+            try:
+                p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=(sys.platform != 'win32'))
+                data, error_data = p.communicate()
+            except OSError as err:
+                log.warning('Failed to run %s: %s', engine, err)
+                return False
+            fmtfilename = os.path.join(tempdir, key + '.fmt')
+            if p.returncode or not os.path.isfile(fmtfilename):
+                log.warning('Failed to dump a TeX format for the preamble. '
+                            'Measuring labels without it')
+                log.debug('Output from %s\n%s', engine, data)
+                return False
+            inputs = []
+            try:
+                with open(os.path.join(tempdir, key + '.fls')) as f:
+                    for line in f:
+                        if line.startswith('INPUT '):
+                            path = os.path.abspath(line[6:].rstrip('\r\n'))
+                            if os.path.dirname(path) != tempdir and path not in inputs:
+                                inputs.append(path)
+            except (IOError, OSError):
+                return False
+            record = {'engine': self._engine_state(engine), 'inputs': self._inputs_state(inputs)}
+            # the format is copied rather than renamed, since the temporary
+            # directory may be on another file system
+            with open(fmtfilename, 'rb') as f:
+                dotparsing.write_file_atomically(os.path.join(self.cachedir, key + '.fmt'), f.read())
+            # the record is written last, so that it only exists next to a
+            # complete format
+            dotparsing.write_file_atomically(os.path.join(self.cachedir, key + '.json'),
+                                             json.dumps(record).encode('utf8'))
+            return True
+        except (IOError, OSError) as err:
+            log.warning('Failed to store the TeX format: %s', err)
+            return False
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+
 class TeXDimProc:
     """Helper class for for finding the size of TeX snippets
 
@@ -1002,80 +2479,185 @@ class TeXDimProc:
         self.snippets_id.append(snippet_id)
         self.snippets_code.append(code)
 
+    def get_engine(self):
+        """Return the TeX engine used to measure the snippets"""
+        return 'pdflatex' if self.options.get('usepdflatex') else 'latex'
+
+    def get_cache(self):
+        """Return the TeX dimension cache selected by the options, or None"""
+        if self.options.get('notexdimcache'):
+            return None
+        filename = self.options.get('texdimcachefile')
+        if not filename and self.options.get('texdimcache'):
+            filename = dotparsing.user_cache_path('texdims.sqlite')
+        return dotparsing.get_shared_cache(TeXDimCache, filename=filename)
+
     def process(self):
         """Process all snippets of code with TeX and preview.sty
 
         Results are stored in the texdimlist and texdims class attributes.
+        Snippets with the same code are only processed once, only snippets
+        that are not in the TeX dimension cache are processed, and TeX is
+        not run at all if every snippet is cached.
         Returns False if preprocessing fails
         """
-        import shutil
-
         if len(self.snippets_code) == 0:
             log.warning('No labels to preprocess')
             return True
-        self.tempdir = tempfile.mkdtemp(prefix='dot2tex')
-        log.debug('Creating temporary directory %s' % self.tempdir)
-        self.tempfilename = os.path.join(self.tempdir, 'dot2tex.tex')
-        log.debug('Creating temporary file %s' % self.tempfilename)
-        s = ""
-        for n in self.snippets_code:
-            s += "\\begin{preview}%\n"
-            s += n.strip() + "%\n"
-            s += r"\end{preview}%\n"
-        with open(self.tempfilename, 'w') as f:
-            f.write(self.template.replace('<<preproccode>>', s))
-        with open(self.tempfilename, 'r') as f:
-            s = f.read()
-        log.debug('Code written to %s\n' % self.tempfilename + s)
-        self.parse_log_file()
-        shutil.rmtree(self.tempdir)
-        log.debug('Temporary directory and files deleted')
+        codes = [code.strip() for code in self.snippets_code]
+        # the distinct snippets in the order they were added
+        unique = list(dict.fromkeys(codes))
+        cache = self.get_cache()
+        dims = {}
+        if cache is not None:
+            context = cache.context(self.template, self.get_engine())
+            dims = cache.get_many(context, unique)
+        todo = [code for code in unique if code not in dims]
+        if todo:
+            log.debug('Measuring %d of %d distinct snippets (%d in all) with TeX',
+                      len(todo), len(unique), len(codes))
+            measured, ok = self.measure(todo)
+            if cache is not None and ok:
+                cache.put_many(context, measured)
+            dims.update(measured)
+        else:
+            log.debug('The dimensions of all snippets are cached, not running TeX')
+        self.texdimlist = [dims[code] for code in codes if code in dims]
+        self.texdims = dict((snippet_id, dims[code])
+                            for snippet_id, code in zip(self.snippets_id, codes) if code in dims)
         if self.texdims:
             return True
         else:
             return False
-            # cleanup
-
-    def parse_log_file(self):
-        logfilename = os.path.splitext(self.tempfilename)[0] + '.log'
-        tmpdir = os.getcwd()
-        os.chdir(os.path.split(logfilename)[0])
-        if self.options.get('usepdflatex'):
-            command = 'pdflatex -interaction=nonstopmode %s' % self.tempfilename
-        else:
-            command = 'latex -interaction=nonstopmode %s' % self.tempfilename
-        log.debug('Running command: %s' % command)
 
-        p = Popen(command, shell=True, stdout=PIPE, stderr=PIPE, close_fds=(sys.platform != 'win32'))
-        (stdout, stderr) = (p.stdout, p.stderr)
+    def get_format_cache(self):
+        """Return the TeX format cache selected by the options, or None"""
+        cachedir = self.options.get('texformatdir')
+        if not cachedir and self.options.get('texformat'):
+            cachedir = dotparsing.user_cache_path('texformats')
+        if not cachedir:
+            return None
+        return dotparsing.get_shared_cache(TeXFormatCache, cachedir=cachedir)
+
+    def get_workers(self):
+        """Return the largest number of TeX processes to run at the same time"""
+        return self.options.get('texworkers') or os.cpu_count() or 1
+
+    def get_shards(self, codes):
+        """Split codes into consecutive parts that are measured by separate TeX processes"""
+        count = min(self.get_workers(), -(-len(codes) // TEX_SHARD_MIN_SNIPPETS))
+        if count <= 1:
+            return [codes]
+        size, rest = divmod(len(codes), count)
+        shards = []
+        start = 0
+        for i in range(count):
+            end = start + size + (i < rest)
+            shards.append(codes[start:end])
+            start = end
+        return shards
+
+    def measure(self, codes):
+        """Find the size of snippets of code with TeX
+
+        Large sets of snippets are split into shards that are measured by
+        TeX processes running in parallel. If a TeX format cache is
+        selected, the processes load a format with the dumped preamble of
+        the template instead of running it. Returns a dictionary with the
+        (height, depth, width) of the snippets and whether TeX ran without
+        errors.
+        """
+        formats = self.get_format_cache()
+        texformat = None
+        begin = self.template.find('\\begin{document}')
+        if formats is not None and begin > 0:
+            texformat = formats.get(self.get_engine(), self.template[:begin])
+        shards = self.get_shards(codes)
+        results = self.run_shards(shards, texformat)
+        if texformat is not None and not any(texdimlist for texdimlist, logdata in results):
+            log.warning('No dimensions were found with the dumped TeX format. '
+                        'Measuring the labels without it')
+            formats.discard(texformat)
+            results = self.run_shards(shards)
+        dims = {}
+        ok = True
+        for shard, (texdimlist, logdata) in zip(shards, results):
+            for number, dim in texdimlist:
+                if 0 < number <= len(shard):
+                    dims[shard[number - 1]] = dim
+            if re.search('^! ', logdata, re.MULTILINE):
+                ok = False
+        return dims, ok and len(dims) == len(codes)
+
+    def run_shards(self, shards, texformat=None):
+        """Measure each shard of snippets with its own TeX process
+
+        Returns the results of run_tex() in the order of the shards.
+        """
+        tempdir = tempfile.mkdtemp(prefix='dot2tex')
+        log.debug('Creating temporary directory %s' % tempdir)
         try:
-            data = stdout.read()
-            log.debug("stdout from latex\n %s", data)
+            if len(shards) == 1:
+                return [self.run_tex(tempdir, 'dot2tex', shards[0], texformat)]
+            log.debug('Measuring the snippets with %d TeX processes', len(shards))
+            with ThreadPoolExecutor(len(shards)) as executor:
+                return list(executor.map(self.run_tex, [tempdir] * len(shards),
+                                         ['dot2tex%d' % i for i in range(len(shards))],
+                                         shards, [texformat] * len(shards)))
         finally:
-            stdout.close()
+            shutil.rmtree(tempdir)
+            log.debug('Temporary directory and files deleted')
 
+    def run_tex(self, tempdir, jobname, codes, texformat=None):
+        """Measure snippets of code with a TeX run in tempdir
+
+        With texformat, the format with the dumped preamble is loaded and
+        only the rest of the template is run. The working directory is not
+        changed, so snippets can be measured in several threads at once.
+        Returns the snippet numbers and dimensions found in the log, and
+        the log.
+        """
+        texfilename = os.path.join(tempdir, jobname + '.tex')
+        logfilename = os.path.join(tempdir, jobname + '.log')
+        s = ""
+        for n in codes:
+            s += "\\begin{preview}%\n"
+            s += n + "%\n"
+            s += "\\end{preview}%\n"
+        code = self.template.replace('<<preproccode>>', s)
+        args = [self.get_engine(), '-interaction=nonstopmode', '-output-directory=' + tempdir, texfilename]
+        env = None
+        if texformat is not None:
+            code = code[code.find('\\begin{document}'):]
+            args.insert(1, '-fmt=' + texformat)
+            env = self.get_format_cache().environ()
+        with open(texfilename, 'w') as f:
+            f.write(code)
+        log.debug('Code written to %s\n' % texfilename + code)
+        log.debug('Running command: %s' % ' '.join(args))
         try:
-            error_data = stderr.read()
-            if error_data:
-                log.debug('latex STDERR %s', error_data)
-        finally:
-            stderr.close()
-        p.kill()
-        p.wait()
+            p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, env=env, close_fds=(sys.platform != 'win32'))
+        except OSError as err:
+            log.error('Failed to run %s: %s', args[0], err)
+            return [], ''
+        data, error_data = p.communicate()
+        log.debug("stdout from latex\n %s", data)
+        if error_data:
+            log.debug('latex STDERR %s', error_data)
 
-        with open(logfilename, 'r') as f:
-            logdata = f.read()
+        try:
+            with open(logfilename, 'r') as f:
+                logdata = f.read()
+        except (IOError, OSError):
+            logdata = ''
         log.debug('Logfile from LaTeX run: \n' + logdata)
-        os.chdir(tmpdir)
 
         texdimdata = self.dimext_re.findall(logdata)
         log.debug('Texdimdata: ' + str(texdimdata))
         if len(texdimdata) == 0:
-            log.error('No dimension data could be extracted from dot2tex.tex.')
-            self.texdims = None
-            return
+            log.error('No dimension data could be extracted from %s.', os.path.basename(texfilename))
 
         c = 1.0 / 4736286
-        self.texdims = {}
-        self.texdimlist = [(float(i[1]) * c, float(i[2]) * c, float(i[3]) * c) for i in texdimdata]
-        self.texdims = dict(zip(self.snippets_id, self.texdimlist))
+        texdimlist = [(int(i[0]), (float(i[1]) * c, float(i[2]) * c, float(i[3]) * c))
+                      for i in texdimdata]
+        return texdimlist, logdata
@@ -210,6 +210,28 @@ def create_options_parser():
         default='', help='Pass options to graph layout engine',
         metavar='OPTIONS'
     )
+    parser.add_argument(
+        '--progtimeout', dest='progtimeout', type=float, metavar='SECONDS',
+        default=None, help='Give up if Graphviz has not finished after SECONDS'
+    )
+    parser.add_argument(
+        '--nogvbinding', dest='nogvbinding', action='store_true', default=False,
+        help='Do not lay out graphs in-process with the gv Python binding'
+    )
+    parser.add_argument(
+        '--jsonlayout', dest='jsonlayout', action='store_true', default=False,
+        help='Read the layout from the JSON output of Graphviz instead of its xdot output'
+    )
+    parser.add_argument(
+        '--graphvizworkers', dest='graphvizworkers', type=int, metavar='N',
+        default=None, help='Keep up to N Graphviz processes per layout program running '
+                           'and reuse them. Overrides DOT2TEX_GRAPHVIZ_WORKERS'
+    )
+    parser.add_argument(
+        '--graphvizdir', dest='graphvizdir', metavar='DIR', default=None,
+        help='Directory of the Graphviz executables. Overrides the '
+             'DOT2TEX_GRAPHVIZ_DIR environment variable and the search path'
+    )
     parser.add_argument(
         '--autosize', dest='autosize',
         help='Preprocess graph and then run Graphviz',
@@ -218,6 +240,59 @@ def create_options_parser():
     parser.add_argument(
         '--cache', dest='cache', action='store_true', default=False
     )
+    parser.add_argument(
+        '--parsecache', dest='parsecache', action='store_true', default=False,
+        help='Cache parsed graphs in the user cache directory'
+    )
+    parser.add_argument(
+        '--parsecachedir', dest='parsecachedir', metavar='DIR', default=None,
+        help='Directory of the parse cache. Implies --parsecache'
+    )
+    parser.add_argument(
+        '--nolayoutcache', dest='nolayoutcache', action='store_true', default=False,
+        help='Do not reuse the layout of a graph that has been laid out before'
+    )
+    parser.add_argument(
+        '--layoutcache', dest='layoutcache', action='store_true', default=False,
+        help='Keep layouts in the user cache directory, so that later runs can reuse them'
+    )
+    parser.add_argument(
+        '--layoutcachedir', dest='layoutcachedir', metavar='DIR', default=None,
+        help='Directory of the layout cache. Implies --layoutcache'
+    )
+    parser.add_argument(
+        '--reuselayout', dest='reuselayout', action='store_true', default=False,
+        help='If only labels and styles have changed since the graph was last laid out, '
+             'keep the positions of the nodes. Use with --layoutcache to reuse layouts '
+             'between runs'
+    )
+    parser.add_argument(
+        '--notexdimcache', dest='notexdimcache', action='store_true', default=False,
+        help='Measure every label with LaTeX when preprocessing, even if it has been measured before'
+    )
+    parser.add_argument(
+        '--texdimcache', dest='texdimcache', action='store_true', default=False,
+        help='Keep label dimensions in the user cache directory, so that later runs '
+             'do not have to measure them with LaTeX again'
+    )
+    parser.add_argument(
+        '--texdimcachefile', dest='texdimcachefile', metavar='FILE', default=None,
+        help='SQLite database of the label dimension cache. Implies --texdimcache'
+    )
+    parser.add_argument(
+        '--texworkers', dest='texworkers', type=int, metavar='N', default=None,
+        help='Measure labels with up to N LaTeX processes at the same time. '
+             'Defaults to the number of processors'
+    )
+    parser.add_argument(
+        '--texformat', dest='texformat', action='store_true', default=False,
+        help='Dump the preamble used for measuring labels to a LaTeX format in the user '
+             'cache directory and load it instead of running the preamble every time'
+    )
+    parser.add_argument(
+        '--texformatdir', dest='texformatdir', metavar='DIR', default=None,
+        help='Directory of the dumped LaTeX formats. Implies --texformat'
+    )
     parser.add_argument(
         '--pgf118', dest='pgf118', action='store_true',
         help='Generate code compatible with PGF 1.18', default=False
@@ -250,6 +325,7 @@ def _runtests():
 
 def print_version_info():
     print("Dot2tex version % s" % __version__)
+    print("Graphviz version %s" % (dotparsing.get_graphviz_version() or 'not found'))
 
 
 def load_dot_file(filename):
@@ -434,31 +510,62 @@ def main(run_as_module=False, dotdata=None, options=None):
     options.format = output_format
 
     if output_format in ('pstricks', 'pst'):
-        conv = Dot2PSTricksConv(options.__dict__)
+        Conv = Dot2PSTricksConv
     elif output_format == 'psn':
-        conv = Dot2PSTricksNConv(options.__dict__)
+        Conv = Dot2PSTricksNConv
     elif output_format == 'pgf':
-        conv = Dot2PGFConv(options.__dict__)
+        Conv = Dot2PGFConv
     elif output_format == 'tikz':
-        conv = Dot2TikZConv(options.__dict__)
+        Conv = Dot2TikZConv
     elif output_format == 'positions':
-        conv = PositionsDotConv(options.__dict__)
+        Conv = PositionsDotConv
     else:
         log.error("Unknown output format %s" % options.format)
         sys.exit(1)
+    outputs = []
+    f = None
     try:
-        s = conv.convert(dotdata)
-        log.debug('Output:\n%s', s)
-        if options.autosize:
-            conv.dopreproc = False
-            s = conv.convert(s)
-            log.debug('Output after preprocessing:\n%s', s)
-        if options.outputfile:
-            with open(options.outputfile, 'w') as f:
-                f.write(s)
+        # The input may contain several graphs, for instance the output of
+        # dot -Txdot a.gv b.gv. They are parsed and converted one at a time,
+        # each from its own source text, so that the parse cache is used and
+        # Graphviz gets the graph as it was written.
+        for source in dotparsing.DotDataParser().iter_dot_sources(dotdata):
+            # the converter keeps state and adds to its options
+            conv = Conv(dict(options.__dict__))
+            if options.outputfile:
+                if f is None:
+                    f = open(options.outputfile, 'w')
+                else:
+                    f.write('\n')
+            if options.autosize or run_as_module:
+                s = conv.convert(source)
+                log.debug('Output:\n%s', s)
+                if options.autosize:
+                    conv.dopreproc = False
+                    s = conv.convert(s)
+                    log.debug('Output after preprocessing:\n%s', s)
+                chunks = [s]
+            else:
+                # write the output as it is generated
+                chunks = conv.convert_iter(source)
+            if options.outputfile:
+                for chunk in chunks:
+                    f.write(chunk)
+            elif not run_as_module:
+                for chunk in chunks:
+                    sys.stdout.write(str(chunk))
+                sys.stdout.write('\n')
+            if run_as_module:
+                outputs.append(s)
+            # let go of the graph and the converter before the next graph is parsed
+            del conv, chunks
+        if len(outputs) == 1:
+            s = outputs[0]
+        elif all(isinstance(output, str) for output in outputs):
+            s = '\n'.join(outputs)
         else:
-            if not run_as_module:
-                print(s)
+            # for instance the dictionaries of the positions format
+            s = outputs
     except dotparsing.ParseException as err:
         errmsg = "Parse error:\n%s\n" % err.line + " " * (err.column - 1) + "^\n" + str(err)
         log.error(errmsg)
@@ -476,6 +583,9 @@ def main(run_as_module=False, dotdata=None, options=None):
         log.exception('Failed to process input')
         if run_as_module:
             raise
+    finally:
+        if f:
+            f.close()
 
     log.info('------- End of run -------')
     if run_as_module:
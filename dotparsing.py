@@ -13,17 +13,29 @@ __author__ = ['Michael Krause', 'Ero Carrera', 'Kjell Magne Fauske']
 __license__ = 'MIT'
 
 import re
+import io
 import itertools
 import os
 import logging
 import string
+import threading
+import gc
+import hashlib
+import json
+import tempfile
+import zlib
+from array import array
+from collections import OrderedDict
+from functools import lru_cache
+from subprocess import Popen, PIPE
+from sys import intern
 
 import pyparsing
+from pyparsing import __version__ as pyparsing_version
 from pyparsing import (Literal, CaselessLiteral, Word, OneOrMore, Forward, Group, Optional, Combine, restOfLine,
                        cStyleComment, nums, alphanums,
                        ParseException, CharsNotIn, Suppress, Regex, removeQuotes)
 
-from collections import OrderedDict
 
 dot_keywords = ['graph', 'subgraph', 'digraph', 'node', 'edge', 'strict']
 
@@ -32,6 +44,7 @@ id_re_num = re.compile(r'^-?(\.[0-9]+|[0-9]+(\.[0-9]*)?)$')
 id_re_with_port = re.compile('^.*:([^"]+|[^"]*\"[^"]*\"[^"]*)$')
 id_re_dbl_quoted = re.compile('^\".*\"$', re.S)
 id_re_html = re.compile('^<<.*>>$', re.S)
+id_re_non_ascii = re.compile('[\x00\x80-\U0010ffff]')
 
 log = logging.getLogger("dot2tex")
 
@@ -48,8 +61,7 @@ def needs_quotes(s):
     if s in dot_keywords:
         return True
 
-    chars = [ord(c) for c in s if ord(c) > 0x7f or ord(c) == 0]
-    if chars:
+    if id_re_non_ascii.search(s):
         return True
 
     res = id_re_alpha_nums.match(s)
@@ -73,6 +85,12 @@ def needs_quotes(s):
 def quote_if_necessary(s):
     if not isinstance(s, str):
         return s
+    return _quote(s)
+
+
+# The same names and values are quoted over and over when a graph is written
+@lru_cache(maxsize=4096)
+def _quote(s):
     tmp = s
     if needs_quotes(tmp):
         tmp = '"%s"' % s  # .replace('"','\\"')
@@ -81,6 +99,35 @@ def quote_if_necessary(s):
     return tmp
 
 
+def write_attr_list(fp, attr):
+    """Write attributes as a comma separated list of key=value pairs"""
+    sep = ''
+    for key, val in attr.items():
+        if not isinstance(val, str):
+            # numbers set by the converters and decoded draw attributes
+            val = str(val)
+        fp.write('%s%s=%s' % (sep, quote_if_necessary(key), quote_if_necessary(val)))
+        sep = ','
+
+
+def dot_string(element):
+    """Return the DOT code written by element.write"""
+    fp = io.StringIO()
+    element.write(fp)
+    return fp.getvalue()
+
+
+def intern_attr(key, value):
+    """Return an interned attribute key and, if it is short, value
+
+    Attribute names and values like black, circle and solid are repeated for
+    many elements, and interned strings are shared between them.
+    """
+    if len(value) <= 16:
+        value = intern(value)
+    return intern(key), value
+
+
 def flatten(lst):
     for elem in lst:
         if type(elem) in (tuple, list):
@@ -172,11 +219,81 @@ def __find_executables(path):
         return None
 
 
+# Environment variable naming the directory of the Graphviz executables
+GRAPHVIZ_DIR_ENV = 'DOT2TEX_GRAPHVIZ_DIR'
+
+# Searching for Graphviz stats a lot of files, so the result is kept for
+# the lifetime of the process, keyed by the override directory
+_graphviz_progs = {}
+_graphviz_versions = {}
+_graphviz_lock = threading.Lock()
+
+
+def find_graphviz(path=None):
+    """Locate Graphviz's executables
+
+    Returns a dictionary with the program names as keys and their paths as
+    values, or None. If path, or else the DOT2TEX_GRAPHVIZ_DIR environment
+    variable, is set only that directory is searched. The result is
+    remembered until invalidate_graphviz() is called.
+    """
+    if path is None:
+        path = os.environ.get(GRAPHVIZ_DIR_ENV) or None
+    with _graphviz_lock:
+        if path in _graphviz_progs:
+            progs = _graphviz_progs[path]
+            return dict(progs) if progs else progs
+    if path:
+        progs = __find_executables(path)
+        if progs is None:
+            log.warning('No Graphviz executables found in %s', path)
+    else:
+        progs = search_graphviz()
+    with _graphviz_lock:
+        _graphviz_progs[path] = progs
+    return dict(progs) if progs else progs
+
+
+def invalidate_graphviz():
+    """Forget the Graphviz executables and versions found so far"""
+    with _graphviz_lock:
+        _graphviz_progs.clear()
+        _graphviz_versions.clear()
+
+
+def get_graphviz_version(path=None):
+    """Return the version of Graphviz as a string, like '2.43.0', or None
+
+    The version is read from the output of dot -V once per executable.
+    """
+    progs = find_graphviz(path)
+    if not progs or not progs.get('dot'):
+        return None
+    dot = progs['dot'].strip('"')
+    with _graphviz_lock:
+        if dot in _graphviz_versions:
+            return _graphviz_versions[dot]
+    version = None
+    try:
+        p = Popen([dot, '-V'], stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        m = re.search(r'version\s+(\S+)', (stderr + stdout).decode('utf8', 'replace'))
+        if m:
+            version = m.group(1)
+        else:
+            log.warning('Could not determine the Graphviz version')
+    except OSError as err:
+        log.warning('Failed to run %s: %s', dot, err)
+    with _graphviz_lock:
+        _graphviz_versions[dot] = version
+    return version
+
+
 # The following function is from the pydot project
 # The multi-platform version of this 'find_graphviz' function was
 # contributed by Peter Cock
 #
-def find_graphviz():
+def search_graphviz():
     """Locate Graphviz's executables in the system.
 
     Tries three methods:
@@ -285,25 +402,135 @@ SET_DEF_EDGE_ATTR = 'set_def_edge_attr'
 SET_DEF_GRAPH_ATTR = 'set_def_graph_attr'
 SET_GRAPH_ATTR = 'set_graph_attr'
 
+# Parse events. Apart from these, the events are the commands above, except
+# that an ADD_SUBGRAPH command is replaced by its statements enclosed in
+# START_SUBGRAPH and END_SUBGRAPH events.
+START_GRAPH = 'start_graph'
+END_GRAPH = 'end_graph'
+START_SUBGRAPH = 'start_subgraph'
+END_SUBGRAPH = 'end_subgraph'
+
+
+def edge_stmt_commands(toks):
+    """Expand an edge statement into a list of commands
+
+    toks is a list on the form [point, edgeop, point, ..., options], where
+    each point is a node name, a (node name, port) tuple or an ADD_SUBGRAPH
+    command. The trailing options dict is optional.
+    """
+    edgelist = []
+    opts = toks[-1]
+    if not isinstance(opts, dict):
+        opts = {}
+    for src, op, dest in windows(toks, length=3, overlap=1, padding=False):
+        # is src or dest a subgraph?
+        srcgraph = destgraph = False
+        if len(src) > 1 and src[0] == ADD_SUBGRAPH:
+            edgelist.append(src)
+            srcgraph = True
+        if len(dest) > 1 and dest[0] == ADD_SUBGRAPH:
+            edgelist.append(dest)
+            destgraph = True
+        if srcgraph or destgraph:
+            if srcgraph and destgraph:
+                edgelist.append((ADD_GRAPH_TO_GRAPH_EDGE, src[1], dest[1], opts))
+            elif srcgraph:
+                edgelist.append((ADD_GRAPH_TO_NODE_EDGE, src[1], dest, opts))
+            else:
+                edgelist.append((ADD_NODE_TO_GRAPH_EDGE, src, dest[1], opts))
+        else:
+            # ordinary edge
+            edgelist.append((ADD_EDGE, src, dest, opts))
+
+    return edgelist
+
+
+def command_events(commands):
+    """Generate parse events from a list of commands"""
+    for command in commands:
+        if command[0] == ADD_SUBGRAPH:
+            yield START_SUBGRAPH, command[1]
+            for event in command_events(command[2]):
+                yield event
+            yield END_SUBGRAPH, command[1]
+        else:
+            yield command
+
+
+def token_events(tokens):
+    """Generate parse events from a (strict, graphtype, name, commands) tuple"""
+    yield START_GRAPH, tokens[2], tokens[0] == 'strict', tokens[1] == 'digraph'
+    for event in command_events(tokens[3]):
+        yield event
+    yield END_GRAPH,
+
+
+# The pyparsing grammar is expensive to build and is therefore shared by all
+# DotDataParser instances in the process. pyparsing elements are not safe to use
+# from several threads at once, so parsing is serialized with a lock.
+_dot_parser = None
+_dot_parser_lock = threading.RLock()
+
+
+def get_dot_parser():
+    """Return the process-wide pyparsing dot grammar
+
+    The grammar is built the first time it is needed. Hold _dot_parser_lock
+    while parsing with it.
+    """
+    global _dot_parser
+    with _dot_parser_lock:
+        if _dot_parser is None:
+            dotparser = DotDataParser().define_dot_parser()
+            try:
+                dotparser.parseWithTabs()
+            except:
+                log.warning('Old version of pyparsing. Parser may not work correctly')
+            _dot_parser = dotparser
+        return _dot_parser
+
+
+_dot_graph_locator = None
+
+
+def get_dot_graph_locator():
+    """Return the shared dot grammar extended to also return the end of the graph
+
+    Parsing returns the graph tokens and the number of characters consumed.
+    Hold _dot_parser_lock while parsing with it.
+    """
+    global _dot_graph_locator
+    with _dot_parser_lock:
+        if _dot_graph_locator is None:
+            locator = pyparsing.Empty().setParseAction(lambda s, loc, toks: loc)
+            # do not skip whitespace, the loc of the empty match is the end of the graph
+            locator.leaveWhitespace()
+            _dot_graph_locator = get_dot_parser() + locator
+        return _dot_graph_locator
+
 
 class DotDataParser(object):
     """Container class for parsing Graphviz dot data"""
 
-    def __init__(self):
-        pass
-        self.dotparser = self.define_dot_parser()
+    def __init__(self, fastparse=True):
+        self.fastparse = fastparse
+
+    dotparser = property(lambda self: get_dot_parser())
 
     # parse actions
-    def _proc_node_id(self, toks):
+    @staticmethod
+    def _proc_node_id(toks):
         if len(toks) > 1:
             return toks[0], toks[1]
         else:
             return toks
 
-    def _proc_attr_list(self, toks):
-        return dict(nsplit(toks, 2))
+    @staticmethod
+    def _proc_attr_list(toks):
+        return dict(intern_attr(key, value) for key, value in nsplit(toks, 2))
 
-    def _proc_attr_list_combine(self, toks):
+    @staticmethod
+    def _proc_attr_list_combine(toks):
         if toks:
             first_dict = toks[0]
             for d in toks:
@@ -312,45 +539,25 @@ class DotDataParser(object):
             return first_dict
         return toks
 
-    def _proc_attr_assignment(self, toks):
+    @staticmethod
+    def _proc_attr_assignment(toks):
         return SET_GRAPH_ATTR, dict(nsplit(toks, 2))
 
-    def _proc_node_stmt(self, toks):
+    @staticmethod
+    def _proc_node_stmt(toks):
         """Return (ADD_NODE, node_name, options)"""
         if len(toks) == 2:
             return tuple([ADD_NODE] + list(toks))
         else:
             return tuple([ADD_NODE] + list(toks) + [{}])
 
-    def _proc_edge_stmt(self, toks):
+    @staticmethod
+    def _proc_edge_stmt(toks):
         """Return (ADD_EDGE, src, dest, options)"""
-        edgelist = []
-        opts = toks[-1]
-        if not isinstance(opts, dict):
-            opts = {}
-        for src, op, dest in windows(toks, length=3, overlap=1, padding=False):
-            # is src or dest a subgraph?
-            srcgraph = destgraph = False
-            if len(src) > 1 and src[0] == ADD_SUBGRAPH:
-                edgelist.append(src)
-                srcgraph = True
-            if len(dest) > 1 and dest[0] == ADD_SUBGRAPH:
-                edgelist.append(dest)
-                destgraph = True
-            if srcgraph or destgraph:
-                if srcgraph and destgraph:
-                    edgelist.append((ADD_GRAPH_TO_GRAPH_EDGE, src[1], dest[1], opts))
-                elif srcgraph:
-                    edgelist.append((ADD_GRAPH_TO_NODE_EDGE, src[1], dest, opts))
-                else:
-                    edgelist.append((ADD_NODE_TO_GRAPH_EDGE, src, dest[1], opts))
-            else:
-                # ordinary edge
-                edgelist.append((ADD_EDGE, src, dest, opts))
-
-        return edgelist
+        return edge_stmt_commands(toks)
 
-    def _proc_default_attr_stmt(self, toks):
+    @staticmethod
+    def _proc_default_attr_stmt(toks):
         """Return (ADD_DEFAULT_NODE_ATTR,options"""
         if len(toks) == 1:
             gtype = toks
@@ -366,11 +573,13 @@ class DotDataParser(object):
         else:
             return 'unknown', toks
 
-    def _proc_subgraph_stmt(self, toks):
+    @staticmethod
+    def _proc_subgraph_stmt(toks):
         """Returns (ADD_SUBGRAPH, name, elements)"""
         return 'add_subgraph', toks[1], toks[2].asList()
 
-    def _main_graph_stmt(self, toks):
+    @staticmethod
+    def _main_graph_stmt(toks):
         return toks[0], toks[1], toks[2], toks[3].asList()
 
     # The dot grammar is based on the dot parser from the pydot project.
@@ -507,115 +716,95 @@ class DotDataParser(object):
         return graphparser
 
     def build_graph(self, graph, tokens):
-        subgraph = None
-        for element in tokens:
-            cmd = element[0]
-            if cmd == ADD_NODE:
-                cmd, nodename, opts = element
-                node = graph.add_node(nodename, **opts)
-                graph.allitems.append(node)
-
-            elif cmd == ADD_EDGE:
-                cmd, src, dest, opts = element
-                srcport = destport = ""
-                if isinstance(src, tuple):
-                    srcport = src[1]
-                    src = src[0]
-                if isinstance(dest, tuple):
-                    destport = dest[1]
-                    dest = dest[0]
-                edge = graph.add_edge(src, dest, srcport, destport, **opts)
-                graph.allitems.append(edge)
-            elif cmd in [ADD_GRAPH_TO_NODE_EDGE, ADD_GRAPH_TO_GRAPH_EDGE, ADD_NODE_TO_GRAPH_EDGE]:
-                cmd, src, dest, opts = element
-                srcport = destport = ""
-                if isinstance(src, tuple):
-                    srcport = src[1]
-
-                if isinstance(dest, tuple):
-                    destport = dest[1]
-                if cmd != ADD_NODE_TO_GRAPH_EDGE:
-                    if cmd == ADD_GRAPH_TO_NODE_EDGE:
-                        src = subgraph
-                    else:
-                        src = prev_subgraph
-                        dest = subgraph
-                else:
-                    dest = subgraph
-
-                edges = graph.add_special_edge(src, dest, srcport, destport, **opts)
-                graph.allitems.extend(edges)
-
-            elif cmd == SET_GRAPH_ATTR:
-                graph.set_attr(**element[1])
-
-            elif cmd == SET_DEF_NODE_ATTR:
-                graph.add_default_node_attr(**element[1])
-                defattr = DotDefaultAttr('node', **element[1])
-                graph.allitems.append(defattr)
-            elif cmd == SET_DEF_EDGE_ATTR:
-                graph.add_default_edge_attr(**element[1])
-                defattr = DotDefaultAttr('edge', **element[1])
-                graph.allitems.append(defattr)
-            elif cmd == SET_DEF_GRAPH_ATTR:
-                graph.add_default_graph_attr(**element[1])
-                defattr = DotDefaultAttr('graph', **element[1])
-                graph.allitems.append(defattr)
-                graph.attr.update(**element[1])
-            elif cmd == ADD_SUBGRAPH:
-                cmd, name, elements = element
-                # print("Adding subgraph")
-                if subgraph:
-                    prev_subgraph = subgraph
-                subgraph = graph.add_subgraph(name)
-                subgraph = self.build_graph(subgraph, elements)
-                graph.allitems.append(subgraph)
-
+        DotGraphBuilder(graph).build(command_events(tokens))
         return graph
 
     def build_top_graph(self, tokens):
         """Build a DotGraph instance from parsed data"""
-        # get basic graph information
-        strict = tokens[0] == 'strict'
-        graphtype = tokens[1]
-        directed = graphtype == 'digraph'
-        graphname = tokens[2]
-        # lets build the graph
-        graph = DotGraph(graphname, strict, directed)
-        self.graph = self.build_graph(graph, tokens[3])
+        self.graph = DotGraphBuilder().build(token_events(tokens))
+
+    @staticmethod
+    def _normalize_data(data):
+        if os.sys.version_info[0] >= 3 and isinstance(data, bytes):
+            data = data.decode()
+        return data.replace('\\\n', '')
+
+    def _iter_graph_events(self, ndata, start, end, fastparser=None):
+        """Generate the parse events of the graph starting at position start
+
+        The position after the graph is stored in end[0].
+        """
+        count = 0
+        if self.fastparse:
+            fastparser = fastparser or DotFastParser()
+            try:
+                for event in fastparser.iterparse(ndata, start):
+                    yield event
+                    count += 1
+                end[0] = fastparser.pos
+                return
+            except DotFastParseError as err:
+                log.debug('Fast parser gave up (%s). Falling back to pyparsing', err)
+        with _dot_parser_lock:
+            if start:
+                ndata = ndata[start:]
+            tokens, length = get_dot_graph_locator().parseString(ndata)
+        end[0] = start + length
+        # skip the events that have already been generated
+        for event in itertools.islice(token_events(tokens), count, None):
+            yield event
+
+    def iter_dot_events(self, data):
+        """Parse dot data and generate parse events
+
+        With the fast parser the events are generated as the input is read,
+        without building the token tree first. If the fast parser gives up
+        halfway, the remaining events are taken from the pyparsing grammar.
+        """
+        return self._iter_graph_events(self._normalize_data(data), 0, [0])
 
     def parse_dot_data(self, data):
         """Parse dot data and return a DotGraph instance"""
-        try:
-            try:
-                self.dotparser.parseWithTabs()
-            except:
-                log.warning('Old version of pyparsing. Parser may not work correctly')
-            if os.sys.version_info[0] >= 3 and isinstance(data, bytes):
-                data = data.decode()
-            ndata = data.replace('\\\n', '')
-            # lines = data.splitlines()
-            # lines = [l.rstrip('\\') for l in lines]
-            tokens = self.dotparser.parseString(ndata)
-            self.build_top_graph(tokens[0])
-            return self.graph
+        self.graph = DotGraphBuilder().build(self.iter_dot_events(data))
+        return self.graph
 
-        except ParseException:
-            # print(err.line)
-            # print(" "*(err.column-1) + "^")
-            # print(err)
-            # return None
-            raise
+    def iter_dot_graphs(self, data):
+        """Parse dot data with any number of graphs and generate a DotGraph for each
+
+        Graphviz writes the graphs one after another when it is given
+        several input files. Each graph is parsed only when it is requested,
+        so only one graph at a time needs to be kept in memory.
+        """
+        ndata = self._normalize_data(data)
+        fastparser = DotFastParser()
+        end = [0]
+        while True:
+            start = _fp_skip_re.match(ndata, end[0]).end()
+            if start >= len(ndata):
+                return
+            yield DotGraphBuilder().build(self._iter_graph_events(ndata, start, end, fastparser))
+
+    def iter_dot_sources(self, data):
+        """Generate the source text of each graph in dot data with any number of graphs
+
+        The end of each graph is found by matching its braces, without
+        parsing it, so the text can be handed to a parse cache or to
+        Graphviz as it is.
+        """
+        ndata = self._normalize_data(data)
+        end = 0
+        while True:
+            start = _fp_skip_re.match(ndata, end).end()
+            if start >= len(ndata):
+                return
+            end = find_graph_end(ndata, start)
+            yield ndata[start:end]
 
     def parse_dot_data_debug(self, data):
         """Parse dot data"""
         try:
-            try:
-                self.dotparser.parseWithTabs()
-            except:
-                log.warning('Old version of pyparsing. Parser may not work correctly')
-
-            tokens = self.dotparser.parseString(data)
+            with _dot_parser_lock:
+                tokens = self.dotparser.parseString(data)
             self.build_top_graph(tokens[0])
 
             return tokens[0]
@@ -627,20 +816,170 @@ class DotDataParser(object):
             return None
 
 
+# Strings, comments and the characters that open and close blocks and HTML
+# strings. Only these matter for finding the end of a graph.
+_graph_scan_re = re.compile(r'"(?:[^"\\]|\\.)*"|//[^\n]*|/\*.*?\*/|^#[^\n]*|[{}<]',
+                            re.DOTALL | re.MULTILINE)
+_html_scan_re = re.compile(r'[<>]')
+
+
+def find_graph_end(data, start=0):
+    """Return the position after the closing brace of the graph starting at start
+
+    Returns len(data) if the graph is not closed.
+    """
+    depth = 0
+    pos = start
+    while True:
+        m = _graph_scan_re.search(data, pos)
+        if m is None:
+            return len(data)
+        pos = m.end()
+        token = m.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth <= 0:
+                return pos
+        elif token == '<':
+            # HTML strings can contain quotes and braces
+            nesting = 1
+            while nesting:
+                m = _html_scan_re.search(data, pos)
+                if m is None:
+                    return len(data)
+                pos = m.end()
+                nesting += 1 if m.group() == '<' else -1
+
+
+def update_scope(scope, attr):
+    """Return a default attribute scope with attr added on top of scope
+
+    Scopes are shared by many elements and graphs and are never changed in
+    place. An empty scope is replaced by attr itself, so attr must not be
+    changed by the caller afterwards.
+    """
+    if not attr:
+        return scope
+    if not scope:
+        return attr
+    scope = scope.copy()
+    scope.update(attr)
+    return scope
+
+
+_missing = object()
+
+
+class DotAttrScope(dict):
+    """Attribute dict that reads through to a shared scope of defaults
+
+    The dict itself only holds the attributes set on the element. Defaults
+    are looked up in the shared scope and copied only when they are
+    written. Iteration gives the same order as when the defaults are copied
+    into the element after its first nown attributes.
+    """
+    __slots__ = ('defaults', 'nown')
+
+    def __init__(self, attr, defaults, nown=0):
+        dict.__init__(self, attr)
+        self.defaults = defaults
+        self.nown = nown
+
+    def __missing__(self, key):
+        return self.defaults[key]
+
+    def __reduce__(self):
+        return self.__class__, (dict(dict.items(self)), self.defaults, self.nown)
+
+    def _materialize(self):
+        items = self.items()
+        dict.clear(self)
+        dict.update(self, items)
+        self.defaults = {}
+        self.nown = 0
+
+    def get(self, key, default=None):
+        value = dict.get(self, key, _missing)
+        if value is _missing:
+            return self.defaults.get(key, default)
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.defaults
+
+    def __len__(self):
+        return dict.__len__(self) + sum(1 for key in self.defaults if not dict.__contains__(self, key))
+
+    def __iter__(self):
+        defaults = self.defaults
+        if not defaults:
+            return dict.__iter__(self)
+        own = list(dict.__iter__(self))
+        first = own[:self.nown]
+        keys = first + [key for key in defaults if key not in first]
+        keys.extend(key for key in own[self.nown:] if key not in defaults)
+        return iter(keys)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def copy(self):
+        return dict(self.items())
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def __delitem__(self, key):
+        self._materialize()
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        self._materialize()
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._materialize()
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self.defaults = {}
+        self.nown = 0
+
+    def __eq__(self, other):
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
 class DotDefaultAttr(object):
+    __slots__ = ('element_type', 'attr')
+
     def __init__(self, element_type, **kwds):
         self.element_type = element_type
         self.attr = kwds
 
-    def __str__(self):
-        attrstr = ",".join(["%s=%s" % \
-                            (quote_if_necessary(key), quote_if_necessary(val)) \
-                            for key, val in self.attr.items()])
-        if attrstr:
-            attrstr = "[%s]" % attrstr
-            return "%s%s;\n" % (self.element_type, attrstr)
-        else:
-            return ""
+    def write(self, fp):
+        if self.attr:
+            fp.write('%s[' % self.element_type)
+            write_attr_list(fp, self.attr)
+            fp.write('];\n')
+
+    __str__ = dot_string
 
 
 class DotParsingException(Exception):
@@ -649,6 +988,8 @@ class DotParsingException(Exception):
 
 class DotNode(object):
     """Class representing a DOT node"""
+    __slots__ = ('name', 'attr', '_geom')
+    parent = None
 
     def __init__(self, name, **kwds):
         """Create a Node instance
@@ -659,17 +1000,21 @@ class DotNode(object):
 
         """
         self.name = name
-        self.attr = {}
-        self.parent = None
-        self.attr.update(kwds)
+        self.attr = kwds
+        self._geom = None
 
-    def __str__(self):
-        attrstr = ",".join(["%s=%s" % \
-                            (quote_if_necessary(key), quote_if_necessary(val)) \
-                            for key, val in self.attr.items()])
-        if attrstr:
-            attrstr = "[%s]" % attrstr
-        return "%s%s;\n" % (quote_if_necessary(self.name), attrstr)
+    def __reduce__(self):
+        return _restore_node, (self.__class__, self.name, self.attr)
+
+    def write(self, fp):
+        fp.write(quote_if_necessary(self.name))
+        if self.attr:
+            fp.write('[')
+            write_attr_list(fp, self.attr)
+            fp.write(']')
+        fp.write(';\n')
+
+    __str__ = dot_string
 
     def __hash__(self):
         return hash(self.name)
@@ -687,6 +1032,9 @@ class DotNode(object):
             return False
 
     def __getattr__(self, name):
+        # attr is not set yet while unpickling
+        if name == 'attr' or name.startswith('__'):
+            raise AttributeError(name)
         try:
             return self.attr[name]
         except KeyError:
@@ -694,28 +1042,42 @@ class DotNode(object):
 
 
 class DotGraph(object):
-    """Class representing a DOT graph"""
+    """Class representing a DOT graph
+
+    The root graph owns the node, edge and graph registries and the
+    adjacency index, subgraphs share them. An edge belongs to the graph in
+    its parent attribute.
+    """
+    __slots__ = ('_nodes', '_members', '_allnodes', '_alledges', '_edges', '_allgraphs', '_succ', '_pred',
+                 'strict', 'directed', 'subgraphs', 'name', 'padding', 'allitems', 'attr', 'level',
+                 'parent', 'root', 'default_node_attr', 'default_edge_attr', 'default_graph_attr',
+                 '_geom')
 
     def __init__(self, name='G', strict=True, directed=False, **kwds):
-        self._nodes = OrderedDict()
+        self._nodes = {}
         self._allnodes = {}
+        # nodes in this graph and its subgraphs, in the order they were added
+        self._members = self._allnodes
+        # maps (src, dst) to an edge, or to a list of parallel edges
         self._alledges = {}
-        self._allgraphs = []
+        # maps (src, dst) to the list of edges whose parent is this graph
         self._edges = {}
+        # map node names to their outgoing and incoming edges
+        self._succ = {}
+        self._pred = {}
+        self._allgraphs = []
         self.strict = strict
         self.directed = directed
         self.subgraphs = []
         self.name = name
         self.padding = "    "
-        self.seq = 0
         self.allitems = []
 
         self.attr = {}
-        self.strict = strict
         self.level = 0
+        self._geom = None
         self.parent = None
         self.root = self
-        self.adj = {}
 
         self.default_node_attr = {}
         self.default_edge_attr = {}
@@ -729,6 +1091,9 @@ class DotGraph(object):
         return len(self._nodes) + sum(len(s) for s in self.subgraphs)
 
     def __getattr__(self, name):
+        # attr is not set yet while unpickling
+        if name == 'attr' or name.startswith('__'):
+            raise AttributeError(name)
         try:
             return self.attr[name]
         except KeyError:
@@ -741,7 +1106,8 @@ class DotGraph(object):
             return ""
 
     def add_node(self, node, **kwds):
-        if not isinstance(node, DotNode):
+        created = not isinstance(node, DotNode)
+        if created:
             node = DotNode(str(node), **kwds)
         n = node.name
 
@@ -750,31 +1116,32 @@ class DotGraph(object):
         if n in self._allnodes:
             self._allnodes[n].attr.update(kwds)
         else:
-            node.attr.update(self.default_node_attr)
-            node.attr.update(kwds)
+            if not created:
+                node.attr.update(self.default_node_attr)
+                node.attr.update(kwds)
+            elif self.default_node_attr:
+                node.attr = DotAttrScope(node.attr, self.default_node_attr, len(node.attr))
             self._allnodes[n] = node
         if n not in self._nodes:
             self._nodes[n] = node
-
-            # Todo: Adding a node to a subgraph should insert it in parent graphs
-        ##        parent = self.parent
-        ##        if parent:
-        ##            print("Parent %s " % parent.name)
-        ##        while parent:
-        ##            print("Parent %s " % parent.name)
-        ##            if n not in parent._nodes:
-        ##                parent._nodes[n] = node
-        ##                parent = parent.parent
-        ##            else:
-        ##                parent = None
+            # a graph contains all nodes of its subgraphs
+            graph = self
+            while n not in graph._members:
+                graph._members[n] = self._allnodes[n]
+                graph = graph.parent
 
         return node
 
     def add_edge(self, src, dst, srcport="", dstport="", **kwds):
         u = self.add_node(src)
         v = self.add_node(dst)
-        edge = DotEdge(u, v, self.directed, srcport, dstport, **self.default_edge_attr)
-        edge.attr.update(kwds)
+        return self._add_edge(u, v, srcport, dstport, kwds)
+
+    def _add_edge(self, u, v, srcport, dstport, kwds):
+        edge = DotEdge(u, v, self.directed, srcport, dstport, **kwds)
+        if self.default_edge_attr:
+            edge.attr = DotAttrScope(edge.attr, self.default_edge_attr)
+        edge.parent = self
 
         ##        if not self.strict:
         ##            self.adj[u][v]=self.adj[u].get(v,[])+ [edge]
@@ -789,23 +1156,40 @@ class DotGraph(object):
         edgekey = (u.name, v.name)
 
         if edgekey in self._alledges:
-            edgs = self._alledges[edgekey]
             if not self.strict:
-                # edge.parent = edge_parent
-                if edgekey in self._edges:
-                    self._edges[edgekey].append(edge)
-                edgs.append(edge)
+                edgs = self._alledges[edgekey]
+                if isinstance(edgs, DotEdge):
+                    self._alledges[edgekey] = [edgs, edge]
+                else:
+                    edgs.append(edge)
+                self._index_edge(edge)
 
                 ##            else:
                 ##                edgs[0].attributes.update(edge.attributes)
                 ##                return edgs[0]
         else:
-            ##            edge.parent = edge_parent
-            # edge.attr.update(self.default_edge_attr)
-            self._alledges[edgekey] = [edge]
-            self._edges[edgekey] = [edge]
+            # most edges are not parallel, so store them without a list
+            self._alledges[edgekey] = edge
+            self._index_edge(edge)
         return edge
 
+    def _index_edge(self, edge):
+        src = edge.src.name
+        dst = edge.dst.name
+        key = (src, dst)
+        if key in self._edges:
+            self._edges[key].append(edge)
+        else:
+            self._edges[key] = [edge]
+        if src in self._succ:
+            self._succ[src].append(edge)
+        else:
+            self._succ[src] = [edge]
+        if dst in self._pred:
+            self._pred[dst].append(edge)
+        else:
+            self._pred[dst] = [edge]
+
     def add_special_edge(self, src, dst, srcport="", dstport="", **kwds):
         src_is_graph = isinstance(src, DotSubGraph)
         dst_is_graph = isinstance(dst, DotSubGraph)
@@ -818,22 +1202,29 @@ class DotGraph(object):
             dst_nodes = dst.get_all_nodes()
         else:
             dst_nodes = [dst]
+        if not src_nodes or not dst_nodes:
+            return edges
 
-        for src_node in src_nodes:
-            for dst_node in dst_nodes:
-                edge = self.add_edge(src_node, dst_node, srcport, dstport, **kwds)
-                edges.append(edge)
+        # add each node once, in the same order as adding edge by edge would
+        src_nodes[:1] = [self.add_node(src_nodes[0])]
+        dst_nodes = [self.add_node(node) for node in dst_nodes]
+        src_nodes[1:] = [self.add_node(node) for node in src_nodes[1:]]
+        for u in src_nodes:
+            for v in dst_nodes:
+                edges.append(self._add_edge(u, v, srcport, dstport, kwds))
 
         return edges
 
+    # The default attribute dicts are shared with elements and subgraphs.
+    # Use these methods to change them.
     def add_default_node_attr(self, **kwds):
-        self.default_node_attr.update(kwds)
+        self.default_node_attr = update_scope(self.default_node_attr, kwds)
 
     def add_default_edge_attr(self, **kwds):
-        self.default_edge_attr.update(kwds)
+        self.default_edge_attr = update_scope(self.default_edge_attr, kwds)
 
     def add_default_graph_attr(self, **kwds):
-        self.default_graph_attr.update(kwds)
+        self.default_graph_attr = update_scope(self.default_graph_attr, kwds)
 
     ##            #nodecls = self._allnodes[name]
     ##            #nodeparent = nodecls.parent
@@ -871,6 +1262,12 @@ class DotGraph(object):
             del self._allnodes[name]
         except:
             raise DotParsingException("Node %s does not exists" % name)
+        for graph in self._allgraphs:
+            graph._members.pop(name, None)
+
+    def has_node(self, nodename):
+        """Return True if the node is in this graph or one of its subgraphs"""
+        return nodename in self._members
 
     def get_node(self, nodename):
         """Return node with name=nodename
@@ -918,14 +1315,21 @@ class DotGraph(object):
             subgraphcls = DotSubGraph(subgraph, self.strict, self.directed, **kwds)
         subgraphcls._allnodes = self._allnodes
         subgraphcls._alledges = self._alledges
+        subgraphcls._succ = self._succ
+        subgraphcls._pred = self._pred
         subgraphcls._allgraphs = self._allgraphs
         subgraphcls.parent = self
         subgraphcls.root = self.root
         subgraphcls.level = self.level + 1
-        subgraphcls.add_default_node_attr(**self.default_node_attr)
-        subgraphcls.add_default_edge_attr(**self.default_edge_attr)
+        subgraphcls.default_node_attr = update_scope(subgraphcls.default_node_attr,
+                                                     self.default_node_attr)
+        subgraphcls.default_edge_attr = update_scope(subgraphcls.default_edge_attr,
+                                                     self.default_edge_attr)
+        # graph attributes can still change, so they are copied
         subgraphcls.add_default_graph_attr(**self.attr)
-        subgraphcls.attr.update(self.default_graph_attr)
+        if self.default_graph_attr:
+            subgraphcls.attr = DotAttrScope(subgraphcls.attr, self.default_graph_attr,
+                                            len(subgraphcls.attr))
         subgraphcls.padding += self.padding
         self.subgraphs.append(subgraphcls)
         self._allgraphs.append(subgraphcls)
@@ -935,14 +1339,20 @@ class DotGraph(object):
         return self.subgraphs
 
     def get_edges(self):
+        """Return a dict mapping (src, dst) to the list of edges in this graph"""
         return self._edges
 
     def get_all_nodes(self):
-        nodes = []
-        for subgraph in self.get_subgraphs():
-            nodes.extend(subgraph.get_all_nodes())
-        nodes.extend(self._nodes)
-        return nodes
+        """Return the names of the nodes in this graph and its subgraphs"""
+        return list(self._members)
+
+    def get_out_edges(self, nodename):
+        """Return the edges leaving the node, in the order they were added"""
+        return list(self._succ.get(nodename, ()))
+
+    def get_in_edges(self, nodename):
+        """Return the edges entering the node, in the order they were added"""
+        return list(self._pred.get(nodename, ()))
 
     def set_attr(self, **kwds):
         """Set graph attributes"""
@@ -955,80 +1365,82 @@ class DotGraph(object):
     alledges = property(lambda self: flatten(self._alledges.values()))
     edges = property(get_edges)
 
-    def __str__(self):
-        s = ""
+    def write(self, fp):
+        """Write the graph in the DOT language to the text stream fp"""
         padding = self.padding
+        if isinstance(self, DotSubGraph):
+            fp.write('subgraph %s{\n' % self.get_name())
+        else:
+            fp.write('%s%s %s{\n' % ('strict ' if self.strict else '',
+                                     'digraph' if self.directed else 'graph', self.get_name()))
         if len(self.allitems) > 0:
-            grstr = "".join(["%s%s" % (padding, n) for n in map(str, flatten(self.allitems))])
-            attrstr = ",".join(["%s=%s" % \
-                                (quote_if_necessary(key), quote_if_necessary(val)) \
-                                for key, val in self.attr.items()])
-            if attrstr:
-                attrstr = "%sgraph [%s];" % (padding, attrstr)
-            if not isinstance(self, DotSubGraph):
-                s = ""
-                if self.strict:
-                    s += 'strict '
-                if self.directed:
-                    s += "digraph"
-                else:
-                    s += "graph"
-                return "%s %s{\n%s\n%s\n}" % (s, self.get_name(), grstr, attrstr)
-            else:
-                return "%s %s{\n%s\n%s\n%s}" % ('subgraph', self.get_name(), grstr, attrstr, padding)
-
-        subgraphstr = "\n".join(["%s%s" % (padding, n) for n in map(str, self.subgraphs)])
-
-        nodestr = "".join(["%s%s" % (padding, n)
-                           for n in map(str, self._nodes.values())])
-        edgestr = "".join(["%s%s" % (padding, n)
-                           for n in map(str, flatten(self.edges.values()))])
-
-        attrstr = ",".join(["%s=%s" %
-                            (quote_if_necessary(key), quote_if_necessary(val))
-                            for key, val in self.attr.items()])
-        if attrstr:
-            attrstr = "%sgraph [%s];" % (padding, attrstr)
-        if not isinstance(self, DotSubGraph):
-            s = ""
-            if self.strict:
-                s += 'strict '
-            if self.directed:
-                s += "digraph"
-            else:
-                s += "graph"
-            return "%s %s{\n%s\n%s\n%s\n%s\n}" % (s, self.get_name(), subgraphstr, attrstr, nodestr, edgestr)
+            for item in flatten(self.allitems):
+                fp.write(padding)
+                item.write(fp)
+            fp.write('\n')
+            self._write_attr_stmt(fp)
         else:
-            return "%s %s{\n%s\n%s\n%s\n%s\n%s}" % (
-                'subgraph', self.get_name(), subgraphstr, attrstr, nodestr, edgestr, padding)
+            sep = padding
+            for subgraph in self.subgraphs:
+                fp.write(sep)
+                subgraph.write(fp)
+                sep = '\n' + padding
+            fp.write('\n')
+            self._write_attr_stmt(fp)
+            fp.write('\n')
+            for node in self._nodes.values():
+                fp.write(padding)
+                node.write(fp)
+            fp.write('\n')
+            for edge in flatten(self.edges.values()):
+                fp.write(padding)
+                edge.write(fp)
+        fp.write('\n')
+        if isinstance(self, DotSubGraph):
+            fp.write(padding)
+        fp.write('}')
+
+    def _write_attr_stmt(self, fp):
+        if self.attr:
+            fp.write('%sgraph [' % self.padding)
+            write_attr_list(fp, self.attr)
+            fp.write('];')
+
+    __str__ = dot_string
 
 
 class DotEdge(object):
     """Class representing a DOT edge"""
+    __slots__ = ('src', 'dst', 'src_port', 'dst_port', 'attr', 'conn', 'parent', '_geom')
 
     def __init__(self, src, dst, directed=False, src_port="", dst_port="", **kwds):
         self.src = src
         self.dst = dst
         self.src_port = src_port
         self.dst_port = dst_port
-        # self.parent = parent_graph
-        self.attr = {}
+        self.parent = None
         if directed:
             self.conn = "->"
         else:
             self.conn = "--"
 
-        self.attr.update(kwds)
+        self.attr = kwds
+        self._geom = None
 
-    def __str__(self):
-        attrstr = ",".join(["%s=%s" % \
-                            (quote_if_necessary(key), quote_if_necessary(val)) \
-                            for key, val in self.attr.items()])
-        if attrstr:
-            attrstr = "[%s]" % attrstr
-        return "%s%s %s %s%s %s;\n" % (quote_if_necessary(self.src.name), \
-                                       self.src_port, self.conn, \
-                                       quote_if_necessary(self.dst.name), self.dst_port, attrstr)
+    def __reduce__(self):
+        return _restore_edge, (self.__class__, self.src, self.dst, self.src_port, self.dst_port,
+                               self.attr, self.conn, self.parent)
+
+    def write(self, fp):
+        fp.write("%s%s %s %s%s " % (quote_if_necessary(self.src.name), self.src_port, self.conn,
+                                    quote_if_necessary(self.dst.name), self.dst_port))
+        if self.attr:
+            fp.write('[')
+            write_attr_list(fp, self.attr)
+            fp.write(']')
+        fp.write(';\n')
+
+    __str__ = dot_string
 
     def get_source(self):
         return self.src.name
@@ -1037,19 +1449,783 @@ class DotEdge(object):
         return self.dst.name
 
     def __getattr__(self, name):
+        # attr is not set yet while unpickling
+        if name == 'attr' or name.startswith('__'):
+            raise AttributeError(name)
         try:
             return self.attr[name]
         except KeyError:
             raise AttributeError
 
 
+# Nodes and edges are pickled as plain argument tuples. This is smaller and
+# faster to load than the generic protocol for objects with __slots__.
+def _restore_node(cls, name, attr):
+    node = cls.__new__(cls)
+    node.name = name
+    node.attr = attr
+    node._geom = None
+    return node
+
+
+def _restore_edge(cls, src, dst, src_port, dst_port, attr, conn, parent):
+    edge = cls.__new__(cls)
+    edge.src = src
+    edge.dst = dst
+    edge.src_port = src_port
+    edge.dst_port = dst_port
+    edge.attr = attr
+    edge.conn = conn
+    edge.parent = parent
+    edge._geom = None
+    return edge
+
+
+def _number(value):
+    # keep integers as integers, so that they are printed the same way
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def parse_point(value):
+    """Decode a "x,y" point. Returns an (x, y) tuple or None"""
+    coords = value.rstrip('!').split(',')
+    if len(coords) != 2:
+        return None
+    try:
+        return _number(coords[0]), _number(coords[1])
+    except ValueError:
+        return None
+
+
+def parse_rect(value):
+    """Decode a "llx,lly,urx,ury" rectangle. Returns a 4-tuple or None"""
+    coords = value.split(',')
+    if len(coords) != 4:
+        return None
+    try:
+        return tuple(_number(c) for c in coords)
+    except ValueError:
+        return None
+
+
+def parse_spline(value):
+    """Decode the pos attribute of an edge
+
+    Returns a list of (startp, endp, points) tuples, one for each spline.
+    startp and endp are (x, y) tuples or None, points is a flat
+    array('d') of x, y coordinates.
+    """
+    splines = []
+    for segment in value.split(';'):
+        startp = endp = None
+        points = array('d')
+        for token in segment.split():
+            coords = token.split(',')
+            if coords[0] == 's':
+                startp = float(coords[1]), float(coords[2])
+            elif coords[0] == 'e':
+                endp = float(coords[1]), float(coords[2])
+            else:
+                points.append(float(coords[0]))
+                points.append(float(coords[1]))
+        if points:
+            splines.append((startp, endp, points))
+    return splines
+
+
+def parse_size(value):
+    """Decode a width or height attribute. Returns a float or None"""
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def get_geometry(element, name):
+    """Return the geometry attribute name of a node, edge or graph in numeric form
+
+    pos of an edge is decoded with parse_spline, bb with parse_rect, width
+    and height with parse_size and everything else (pos, lp, xlp etc.)
+    with parse_point. Returns None if the attribute is missing. The result
+    is cached on the element until the attribute is assigned a new value.
+    """
+    value = element.attr.get(name)
+    if value is None or value == '':
+        return None
+    cache = element._geom
+    if cache is None:
+        cache = element._geom = {}
+    else:
+        entry = cache.get(name)
+        if entry is not None and entry[0] is value:
+            return entry[1]
+    if not isinstance(value, str):
+        # set by the converters
+        geom = float(value) if name in ('width', 'height') else value
+    elif name == 'pos' and isinstance(element, DotEdge):
+        geom = parse_spline(value)
+    elif name == 'bb':
+        geom = parse_rect(value)
+    elif name in ('width', 'height'):
+        geom = parse_size(value)
+    else:
+        geom = parse_point(value)
+    cache[name] = (value, geom)
+    return geom
+
+
 class DotSubGraph(DotGraph):
     """Class representing a DOT subgraph"""
+    __slots__ = ()
 
     def __init__(self, name='subgG', strict=True, directed=False, **kwds):
         DotGraph.__init__(self, name, strict, directed, **kwds)
 
 
+class DotGraphBuilder(object):
+    """Build a DotGraph from a stream of parse events
+
+    Events can be fed one at a time, so a graph can be built while the
+    input is still being parsed.
+    """
+
+    def __init__(self, graph=None):
+        self.graph = graph
+        # one [graph, last subgraph, previous subgraph] entry per open graph
+        self.stack = []
+        if graph is not None:
+            self.stack.append([graph, None, None])
+
+    def build(self, events):
+        """Feed all events and return the graph"""
+        feed = self.feed
+        for event in events:
+            feed(event)
+        return self.graph
+
+    def feed(self, event):
+        cmd = event[0]
+        level = self.stack[-1] if self.stack else None
+        if cmd == ADD_NODE:
+            graph = level[0]
+            cmd, nodename, opts = event
+            node = graph.add_node(nodename, **opts)
+            graph.allitems.append(node)
+
+        elif cmd == ADD_EDGE:
+            graph = level[0]
+            cmd, src, dest, opts = event
+            srcport = destport = ""
+            if isinstance(src, tuple):
+                srcport = src[1]
+                src = src[0]
+            if isinstance(dest, tuple):
+                destport = dest[1]
+                dest = dest[0]
+            edge = graph.add_edge(src, dest, srcport, destport, **opts)
+            graph.allitems.append(edge)
+        elif cmd in [ADD_GRAPH_TO_NODE_EDGE, ADD_GRAPH_TO_GRAPH_EDGE, ADD_NODE_TO_GRAPH_EDGE]:
+            graph, subgraph, prev_subgraph = level
+            cmd, src, dest, opts = event
+            srcport = destport = ""
+            if isinstance(src, tuple):
+                srcport = src[1]
+
+            if isinstance(dest, tuple):
+                destport = dest[1]
+            if cmd != ADD_NODE_TO_GRAPH_EDGE:
+                if cmd == ADD_GRAPH_TO_NODE_EDGE:
+                    src = subgraph
+                else:
+                    src = prev_subgraph
+                    dest = subgraph
+            else:
+                dest = subgraph
+
+            edges = graph.add_special_edge(src, dest, srcport, destport, **opts)
+            graph.allitems.extend(edges)
+
+        elif cmd == SET_GRAPH_ATTR:
+            level[0].set_attr(**event[1])
+
+        elif cmd == SET_DEF_NODE_ATTR:
+            graph = level[0]
+            graph.add_default_node_attr(**event[1])
+            defattr = DotDefaultAttr('node', **event[1])
+            graph.allitems.append(defattr)
+        elif cmd == SET_DEF_EDGE_ATTR:
+            graph = level[0]
+            graph.add_default_edge_attr(**event[1])
+            defattr = DotDefaultAttr('edge', **event[1])
+            graph.allitems.append(defattr)
+        elif cmd == SET_DEF_GRAPH_ATTR:
+            graph = level[0]
+            graph.add_default_graph_attr(**event[1])
+            defattr = DotDefaultAttr('graph', **event[1])
+            graph.allitems.append(defattr)
+            graph.attr.update(**event[1])
+        elif cmd == START_SUBGRAPH:
+            if level[1]:
+                level[2] = level[1]
+            level[1] = level[0].add_subgraph(event[1])
+            self.stack.append([level[1], None, None])
+        elif cmd == END_SUBGRAPH:
+            subgraph = self.stack.pop()[0]
+            self.stack[-1][0].allitems.append(subgraph)
+        elif cmd == START_GRAPH:
+            cmd, name, strict, directed = event
+            self.graph = DotGraph(name, strict, directed)
+            self.stack.append([self.graph, None, None])
+        elif cmd == END_GRAPH:
+            self.stack.pop()
+
+
+def user_cache_path(name):
+    """Return the path of name in the dot2tex user cache directory
+
+    The directory is $XDG_CACHE_HOME/dot2tex, or ~/.cache/dot2tex.
+    """
+    cachehome = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cachehome, 'dot2tex', name)
+
+
+def write_file_atomically(path, data):
+    """Write the bytes data to path, creating its directory if needed
+
+    The data is written to a temporary file first, so that readers never
+    see a partially written file. Raises OSError on failure.
+    """
+    dirname = os.path.dirname(path) or os.curdir
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmpname, path)
+    except BaseException:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        raise
+
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def get_shared_cache(cls, **kwds):
+    """Return the process-wide instance of the cache class cls for kwds
+
+    The cache is created with cls(**kwds) the first time it is asked for.
+    """
+    key = (cls, tuple(sorted(kwds.items())))
+    with _shared_caches_lock:
+        cache = _shared_caches.get(key)
+        if cache is None:
+            cache = _shared_caches[key] = cls(**kwds)
+        return cache
+
+
+# Change when the parse events change
+PARSE_CACHE_VERSION = 3
+
+# The parse events with (node name, port) tuples in their second and third items
+_edge_events = frozenset((ADD_EDGE, ADD_GRAPH_TO_NODE_EDGE, ADD_NODE_TO_GRAPH_EDGE, ADD_GRAPH_TO_GRAPH_EDGE))
+
+
+class DotParseCache(object):
+    """Cache of parsed graphs keyed by a hash of the dot data
+
+    The parse events of graphs are kept as compressed JSON in an in-memory
+    LRU and, if cachedir is given, in one file per graph in cachedir. Every
+    lookup builds a new graph from the events, so callers are free to
+    modify it.
+    """
+
+    def __init__(self, maxsize=32, cachedir=None):
+        self.maxsize = maxsize
+        self.cachedir = cachedir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, data):
+        """Return the cache key for dot data"""
+        if isinstance(data, bytes):
+            data = data.decode()
+        data = data.replace('\\\n', '').strip()
+        m = hashlib.sha256()
+        m.update(('%s %s %s\0' % (PARSE_CACHE_VERSION, __version__, pyparsing_version)).encode('utf8'))
+        m.update(data.encode('utf8', 'surrogatepass'))
+        return m.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key + '.events')
+
+    def get(self, key):
+        """Return a copy of the cached graph, or None"""
+        with self._lock:
+            blob = self._entries.get(key)
+            if blob is not None:
+                self._entries.move_to_end(key)
+        if blob is None and self.cachedir:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    blob = f.read()
+            except (IOError, OSError):
+                return None
+            self._remember(key, blob)
+        if blob is None:
+            return None
+        try:
+            return self._load(blob)
+        except Exception:
+            log.warning('Discarding unreadable parse cache entry %s', key)
+            with self._lock:
+                self._entries.pop(key, None)
+            return None
+
+    def put(self, key, events):
+        """Store the parse events of a graph"""
+        blob = zlib.compress(json.dumps(events, separators=(',', ':')).encode('utf8', 'surrogatepass'), 1)
+        self._remember(key, blob)
+        if self.cachedir:
+            try:
+                write_file_atomically(self._path(key), blob)
+            except (IOError, OSError) as err:
+                log.warning('Failed to write parse cache entry: %s', err)
+
+    def clear(self):
+        """Empty the in-memory tier"""
+        with self._lock:
+            self._entries.clear()
+
+    def _remember(self, key, blob):
+        with self._lock:
+            self._entries[key] = blob
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _load(blob):
+        # the many small objects of a large graph trigger a lot of pointless
+        # garbage collection runs while building it
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            events = json.loads(zlib.decompress(blob).decode('utf8', 'surrogatepass'))
+            builder = DotGraphBuilder()
+            for event in events:
+                if event[0] in _edge_events:
+                    # JSON turns the (node name, port) tuples into lists
+                    if isinstance(event[1], list):
+                        event[1] = tuple(event[1])
+                    if isinstance(event[2], list):
+                        event[2] = tuple(event[2])
+                builder.feed(event)
+            return builder.graph
+        finally:
+            if enabled:
+                gc.enable()
+
+    def parse_dot_data(self, data, fastparse=True):
+        """Parse dot data, or return a copy of the cached result"""
+        key = self.key(data)
+        graph = self.get(key)
+        if graph is not None:
+            log.debug('Parse cache hit for %s', key)
+            return graph
+        events = list(DotDataParser(fastparse).iter_dot_events(data))
+        self.put(key, events)
+        return DotGraphBuilder().build(events)
+
+
+class DotFastParseError(DotParsingException):
+    """Raised when DotFastParser can not handle the input"""
+
+
+# Tokens used by the fast parser. Whitespace and comments are handled the same
+# way as in the pyparsing grammar.
+_fp_skip_re = re.compile(r'(?:[ \t\r\n]+|//[^\n]*|#[^\n]*|/\*(?:[^*]|\*(?!/))*\*/)*')
+_fp_alpha_re = re.compile(r'[A-Za-z0-9_\x80-\U0010ffff]+')
+_fp_num_re = re.compile(r'-?[0-9.]+')
+_fp_dbl_quoted_re = re.compile(r'\"(?:\\\"|\\\\|[^"])*\"')
+_fp_alpha_chars = frozenset(string.ascii_letters + string.digits + '_')
+_fp_num_chars = frozenset(string.digits + '.')
+
+FP_ALPHA = 'alpha'
+FP_NUM = 'num'
+FP_QUOTED = 'quoted'
+FP_HTML = 'html'
+
+
+class DotFastParser(object):
+    """Hand-written recursive descent parser for the dot language
+
+    Returns the same command tuples as the pyparsing grammar defined in
+    DotDataParser.define_dot_parser, but is several times faster. Input
+    that the pyparsing grammar would treat in a surprising way (adjacent
+    numerals and identifiers, compass points in parentheses etc.) is
+    rejected with a DotFastParseError, so that the caller can fall back to
+    the pyparsing grammar.
+    """
+
+    data = None
+
+    def parse(self, data, start=0):
+        """Parse the first graph in data after position start
+
+        Returns a (strict, graphtype, name, statements) tuple. The end of
+        the graph is left in the pos attribute.
+        """
+        strict, keyword, name = self._graph_head(data, start)
+        stmts = self._stmt_list()
+        self._expect('}')
+        return strict, keyword, name, stmts
+
+    def iterparse(self, data, start=0):
+        """Parse the first graph in data after position start and generate parse events
+
+        Statements are parsed one at a time. Subgraph statements are not
+        parsed as a whole, but generate their events as they are read. When
+        the generator is exhausted, the end of the graph is left in the pos
+        attribute.
+        """
+        strict, keyword, name = self._graph_head(data, start)
+        yield START_GRAPH, name, strict == 'strict', keyword == 'digraph'
+        for event in self._iter_stmt_list():
+            yield event
+        self._expect('}')
+        yield END_GRAPH,
+
+    def _graph_head(self, data, start):
+        if data is not self.data:
+            # the sentinel saves a lot of bounds checking
+            self.data = data
+            self.s = data + '\0'
+            self.n = len(data)
+        self.pos = start
+        self._skip()
+        keyword = self._keyword()
+        strict = 'notstrict'
+        if keyword == 'strict':
+            strict = keyword
+            self._skip()
+            keyword = self._keyword()
+        if keyword not in ('graph', 'digraph'):
+            self._error('expected graph or digraph')
+        self._skip()
+        name = ''
+        if self.s[self.pos] != '{':
+            name = self._id()[1]
+            self._skip()
+        self._expect('{')
+        return strict, keyword, name
+
+    def _error(self, msg):
+        raise DotFastParseError('%s at char %d' % (msg, self.pos))
+
+    def _skip(self):
+        self.pos = _fp_skip_re.match(self.s, self.pos).end()
+
+    def _expect(self, c):
+        if self.s[self.pos] != c:
+            self._error('expected %r' % c)
+        self.pos += 1
+
+    def _keyword(self):
+        kind, value = self._id()
+        if kind != FP_ALPHA:
+            self._error('expected keyword')
+        return value.lower()
+
+    def _check_word_end(self):
+        # pyparsing splits words like 1.5 or 12abc into several tokens
+        s = self.s
+        c = s[self.pos]
+        if c in _fp_alpha_chars or c == '.' or c > '\x7f' or \
+                (c == '-' and s[self.pos + 1] in _fp_num_chars):
+            self._error('ambiguous word')
+
+    def _id(self):
+        """Parse an ID and return a (kind, value) tuple"""
+        s = self.s
+        c = s[self.pos]
+        if c in _fp_alpha_chars or c > '\x7f':
+            m = _fp_alpha_re.match(s, self.pos)
+            value = m.group()
+            if c in _fp_num_chars and not value.isdigit():
+                # pyparsing splits 1b into 1 and b in some places only
+                self._error('ambiguous word')
+            self.pos = m.end()
+            self._check_word_end()
+            return FP_ALPHA, value
+        elif c == '"':
+            return FP_QUOTED, self._quoted()
+        elif c == '<':
+            return FP_HTML, self._html()
+        elif c == '-' or c == '.':
+            m = _fp_num_re.match(s, self.pos)
+            if m:
+                self.pos = m.end()
+                self._check_word_end()
+                return FP_NUM, m.group()
+        self._error('expected ID')
+
+    def _righthand_id(self):
+        c = self.s[self.pos]
+        if c in _fp_num_chars or c == '-':
+            m = _fp_num_re.match(self.s, self.pos)
+            if m:
+                self.pos = m.end()
+                self._check_word_end()
+                return m.group()
+        return self._id()[1]
+
+    def _quoted(self, concat=True):
+        s = self.s
+        m = _fp_dbl_quoted_re.match(s, self.pos)
+        if not m:
+            self._error('unterminated string')
+        self.pos = m.end()
+        if not concat:
+            return m.group()[1:-1]
+        parts = [m.group()[1:-1]]
+        while True:
+            end = self.pos
+            self._skip()
+            if s[self.pos] != '+':
+                self.pos = end
+                break
+            self.pos += 1
+            self._skip()
+            m = _fp_dbl_quoted_re.match(s, self.pos)
+            if not m:
+                self._error('expected string')
+            parts.append(m.group()[1:-1])
+            self.pos = m.end()
+        return ''.join(parts)
+
+    def _html(self):
+        s = self.s
+        start = i = self.pos
+        depth = 0
+        nested = False
+        while i < self.n:
+            c = s[i]
+            if c == '<':
+                depth += 1
+                if depth > 1:
+                    nested = True
+            elif c == '>':
+                depth -= 1
+                if depth == 0:
+                    break
+            i += 1
+        else:
+            self._error('unterminated HTML string')
+        self.pos = i + 1
+        text = s[start + 1:i]
+        if not nested and text.lstrip(' \t\r\n')[:1] in ('"', "'", '/', '#'):
+            # pyparsing treats leading quotes and comments differently
+            self._error('ambiguous HTML string')
+        return '<<%s>>' % text
+
+    def _port(self):
+        s = self.s
+        port = []
+        while s[self.pos] == ':':
+            self.pos += 1
+            c = s[self.pos]
+            if c == '"':
+                port.append(':' + self._quoted(concat=False))
+            elif c == '(':
+                self._error('unsupported port')
+            else:
+                port.append(':' + self._id()[1])
+        if s[self.pos] == '@':
+            self._error('unsupported port')
+        return ''.join(port)
+
+    def _attr_list(self):
+        s = self.s
+        attr = {}
+        while s[self.pos] == '[':
+            self.pos += 1
+            self._skip()
+            while s[self.pos] != ']':
+                key = self._id()[1]
+                self._skip()
+                self._expect('=')
+                self._skip()
+                key, value = intern_attr(key, self._righthand_id())
+                attr[key] = value
+                self._skip()
+                if s[self.pos] == ',':
+                    self.pos += 1
+                    self._skip()
+            self.pos += 1
+            self._skip()
+        return attr
+
+    def _stmt_list(self):
+        s = self.s
+        stmts = []
+        self._skip()
+        while s[self.pos] != '}':
+            self._stmt(stmts)
+            self._skip()
+            if s[self.pos] == ';':
+                self.pos += 1
+                self._skip()
+        return stmts
+
+    def _subgraph(self, name):
+        self._expect('{')
+        stmts = self._stmt_list()
+        self._expect('}')
+        self._skip()
+        if self.s[self.pos] == ';':
+            self.pos += 1
+        return ADD_SUBGRAPH, name, stmts
+
+    def _subgraph_name(self, kind, value):
+        """Return the subgraph name if the ID starts a subgraph, else None
+
+        When a name is returned the position is at the opening brace.
+        """
+        s = self.s
+        if kind == FP_ALPHA and value[:8].lower() == 'subgraph':
+            if len(value) > 8:
+                self._error('ambiguous subgraph keyword')
+            self._skip()
+            name = ''
+            if s[self.pos] != '{':
+                name = self._id()[1]
+                self._skip()
+            return name
+        end = self.pos
+        self._skip()
+        if s[self.pos] == '{':
+            return value
+        self.pos = end
+        return None
+
+    def _edge_point(self, kind, value):
+        """Return a subgraph command, a node name or a (node name, port) tuple"""
+        name = self._subgraph_name(kind, value)
+        if name is not None:
+            return self._subgraph(name)
+        if self.s[self.pos] in ':@':
+            return value, self._port()
+        return value
+
+    def _assignment(self, stmts, key):
+        """Parse the right hand side of an ID '=' ID statement if there is one"""
+        end = self.pos
+        self._skip()
+        if self.s[self.pos] != '=':
+            self.pos = end
+            return False
+        self.pos += 1
+        self._skip()
+        stmts.append((SET_GRAPH_ATTR, {key: self._righthand_id()}))
+        return True
+
+    def _edge_stmt(self, point):
+        """Parse the rest of an edge statement and return its commands"""
+        s = self.s
+        toks = [point]
+        edgeop = s[self.pos:self.pos + 2]
+        while edgeop in ('->', '--'):
+            self.pos += 2
+            self._skip()
+            if s[self.pos] == '{':
+                toks += [edgeop, self._subgraph('')]
+            else:
+                toks += [edgeop, self._edge_point(*self._id())]
+            self._skip()
+            edgeop = s[self.pos:self.pos + 2]
+        if s[self.pos] == '[':
+            toks.append(self._attr_list())
+        return edge_stmt_commands(toks)
+
+    def _stmt(self, stmts):
+        s = self.s
+        if s[self.pos] == '{':
+            kind = value = None
+            point = self._subgraph('')
+        else:
+            kind, value = self._id()
+            if self._assignment(stmts, value):
+                return
+            point = self._edge_point(kind, value)
+        self._stmt_rest(stmts, kind, value, point)
+
+    def _stmt_rest(self, stmts, kind, value, point):
+        s = self.s
+        self._skip()
+        if s[self.pos:self.pos + 2] in ('->', '--'):
+            stmts.extend(self._edge_stmt(point))
+        elif isinstance(point, tuple) and point[0] == ADD_SUBGRAPH:
+            stmts.append(point)
+        elif kind == FP_ALPHA and not isinstance(point, tuple) and s[self.pos] == '[' \
+                and value.lower() in ('node', 'edge', 'graph'):
+            cmd = {'node': SET_DEF_NODE_ATTR, 'edge': SET_DEF_EDGE_ATTR,
+                   'graph': SET_DEF_GRAPH_ATTR}[value.lower()]
+            stmts.append((cmd, self._attr_list()))
+        else:
+            attr = {}
+            if s[self.pos] == '[':
+                attr = self._attr_list()
+            if s[self.pos] == ';':
+                self.pos += 1
+            stmts.append((ADD_NODE, point, attr))
+
+    def _iter_stmt_list(self):
+        s = self.s
+        self._skip()
+        while s[self.pos] != '}':
+            stmts = []
+            name = None
+            if s[self.pos] == '{':
+                name = ''
+            else:
+                kind, value = self._id()
+                if not self._assignment(stmts, value):
+                    name = self._subgraph_name(kind, value)
+                    if name is None:
+                        point = self._edge_point(kind, value)
+                        self._stmt_rest(stmts, kind, value, point)
+            if name is not None:
+                # generate the events of the subgraph body as it is read
+                yield START_SUBGRAPH, name
+                self._expect('{')
+                for event in self._iter_stmt_list():
+                    yield event
+                self._expect('}')
+                yield END_SUBGRAPH, name
+                self._skip()
+                if s[self.pos] == ';':
+                    self.pos += 1
+                self._skip()
+                if s[self.pos:self.pos + 2] in ('->', '--'):
+                    # the first command adds the subgraph again, which has
+                    # already been done
+                    stmts = self._edge_stmt((ADD_SUBGRAPH, name, []))[1:]
+            for event in command_events(stmts):
+                yield event
+            self._skip()
+            if s[self.pos] == ';':
+                self.pos += 1
+                self._skip()
+
+
 testgraph = r"""
 /* Test that the various id types are parsed correctly */
 digraph G {
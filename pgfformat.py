@@ -1,6 +1,7 @@
 import logging
 
-from .base import DotConvBase, parse_drawstring, get_drawobj_lblstyle
+from . import dotparsing
+from .base import DotConvBase, get_drawobj_lblstyle, get_draw_attr
 from .utils import smart_float, nsplit, getboolattr, tikzify
 
 log = logging.getLogger("dot2tex")
@@ -353,24 +354,19 @@ class Dot2PGFConv(DotConvBase):
         return s
 
     def do_edges(self):
-        s = ""
-        s += self.set_color(('cC', "black"))
+        self.emit(self.set_color(('cC', "black")))
         for edge in self.edges:
-            general_draw_string = getattr(edge, '_draw_', "")
-            label_string = getattr(edge, '_ldraw_', "")
-            head_arrow_string = getattr(edge, '_hdraw_', "")
-            tail_arrow_string = getattr(edge, '_tdraw_', "")
-            tail_label_string = getattr(edge, '_tldraw_', "")
-            head_label_string = getattr(edge, '_hldraw_', "")
+            label_string = get_draw_attr(edge, '_ldraw_')
+            tail_label_string = get_draw_attr(edge, '_tldraw_')
+            head_label_string = get_draw_attr(edge, '_hldraw_')
 
             # Note that the order of the draw strings should be the same
             # as in the xdot output.
-            drawstring = general_draw_string + " " + head_arrow_string + " " + tail_arrow_string \
-                         + " " + label_string
-            draw_operations, stat = parse_drawstring(drawstring)
-            if not drawstring.strip():
+            drawops = self.get_draw_ops(edge, ('_draw_', '_hdraw_', '_tdraw_', '_ldraw_'))
+            if drawops is None:
                 continue
-            s += self.output_edge_comment(edge)
+            draw_operations, stat = drawops
+            s = self.output_edge_comment(edge)
             if self.options.get('duplicate'):
                 s += self.start_edge()
                 s += self.do_draw_op(draw_operations, edge, stat)
@@ -387,8 +383,7 @@ class Dot2PGFConv(DotConvBase):
                 else:
                     s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
                     s += self.do_drawstring(head_label_string, edge, "headtexlbl")
-
-        self.body += s
+            self.emit(s)
 
     def draw_edge(self, edge):
         s = ""
@@ -409,9 +404,8 @@ class Dot2PGFConv(DotConvBase):
                     s += self.set_color(('cC', 'black'))
 
             pp = []
-            for point in points:
-                p = point.split(',')
-                pp.append("(%sbp,%sbp)" % (smart_float(p[0]), smart_float(p[1])))
+            for x, y in points:
+                pp.append("(%sbp,%sbp)" % (smart_float(x), smart_float(y)))
 
             edgestyle = edge.attr.get('style', '')
 
@@ -748,10 +742,9 @@ class Dot2TikZConv(Dot2PGFConv):
         return sn
 
     def do_nodes(self):
-        s = ""
         nodeoptions = self.options.get('nodeoptions')
         if nodeoptions:
-            s += "\\begin{scope}[%s]\n" % nodeoptions
+            self.emit("\\begin{scope}[%s]\n" % nodeoptions)
         for node in self.nodes:
             self.currentnode = node
             # detect node type
@@ -765,10 +758,10 @@ class Dot2TikZConv(Dot2PGFConv):
             if shape is None:
                 shape = 'ellipse'
 
-            pos = getattr(node, 'pos', None)
+            pos = dotparsing.get_geometry(node, 'pos')
             if not pos:
                 continue
-            x, y = pos.split(',')
+            x, y = pos
             if dotshape != 'point':
                 label = self.get_label(node)
             else:
@@ -794,13 +787,13 @@ class Dot2TikZConv(Dot2PGFConv):
             #xlabel = node.attr['xlabel'] if 'xlabel' in node.attr else None
             if xlabel is not None:
                 #xlpos = "%sbp,%sbp" % (smart_float(str(float(x)+len(xlabel)*5)), smart_float(y))
-                xlp = getattr(node, 'xlp', None)
+                xlp = dotparsing.get_geometry(node, 'xlp')
                 if not xlp:
                     # The input file had texxlbl, but had no xlabel,
                     # so graphviz didn't generate xlp
-                    xlp = x + ',' + 'y'
-                xlpx, xlpy = xlp.split(',')
-                xlpx = str(abs(float(x)-float(xlpx))+float(x))
+                    xlp = x, y
+                xlpx, xlpy = xlp
+                xlpx = abs(x - xlpx) + x
                 xlpy = y
                 xlpos = "%sbp,%sbp" % (smart_float(xlpx), smart_float(xlpy))
                 sn += "  \\node (%s) at (%s) [%s] {%s};\n" % \
@@ -841,25 +834,23 @@ class Dot2TikZConv(Dot2PGFConv):
                           (tikzify(node.name), pos, drawstr, shape, label)
             sn += self.end_node(node)
 
-            s += sn
+            self.emit(sn)
         if nodeoptions:
-            s += "\\end{scope}\n"
-        self.body += s
+            self.emit("\\end{scope}\n")
 
     def do_edges(self):
-        s = ""
         edgeoptions = self.options.get('edgeoptions')
         if edgeoptions:
-            s += "\\begin{scope}[%s]\n" % edgeoptions
+            self.emit("\\begin{scope}[%s]\n" % edgeoptions)
         for edge in self.edges:
             # general_draw_string = getattr(edge, '_draw_', "")
-            label_string = getattr(edge, '_ldraw_', "")
+            label_string = get_draw_attr(edge, '_ldraw_')
             # head_arrow_string = getattr(edge, '_hdraw_', "")
             # tail_arrow_string = getattr(edge, '_tdraw_', "")
-            tail_label_string = getattr(edge, '_tldraw_', "")
-            head_label_string = getattr(edge, '_hldraw_', "")
+            tail_label_string = get_draw_attr(edge, '_tldraw_')
+            head_label_string = get_draw_attr(edge, '_hldraw_')
             topath = getattr(edge, 'topath', None)
-            s += self.draw_edge(edge)
+            s = self.draw_edge(edge)
             if not self.options.get('tikzedgelabels') and not topath:
                 s += self.do_drawstring(label_string, edge)
                 s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
@@ -867,10 +858,9 @@ class Dot2TikZConv(Dot2PGFConv):
             else:
                 s += self.do_drawstring(tail_label_string, edge, "tailtexlbl")
                 s += self.do_drawstring(head_label_string, edge, "headtexlbl")
-
+            self.emit(s)
         if edgeoptions:
-            s += "\\end{scope}\n"
-        self.body += s
+            self.emit("\\end{scope}\n")
 
     def draw_edge(self, edge):
         s = ""
@@ -886,9 +876,8 @@ class Dot2TikZConv(Dot2PGFConv):
             # ensure that the fill color is the same as the pen color.
             color = edge.attr.get('color', '')
             pp = []
-            for point in points:
-                p = point.split(',')
-                pp.append("(%sbp,%sbp)" % (smart_float(p[0]), smart_float(p[1])))
+            for x, y in points:
+                pp.append("(%sbp,%sbp)" % (smart_float(x), smart_float(y)))
 
             edgestyle = edge.attr.get('style')
 
@@ -961,10 +950,10 @@ class PositionsDotConv(Dot2PGFConv):
     def output(self):
         positions = {}
         for node in self.nodes:
-            pos = getattr(node, 'pos', None)
+            pos = dotparsing.get_geometry(node, 'pos')
             if pos:
-                try:
-                    positions[node.name] = [int(p) for p in pos.split(',')]
-                except ValueError:
-                    positions[node.name] = [float(p) for p in pos.split(',')]
+                if all(isinstance(p, int) for p in pos):
+                    positions[node.name] = list(pos)
+                else:
+                    positions[node.name] = [float(p) for p in pos]
         return positions
@@ -1,5 +1,6 @@
 import logging
 
+from . import dotparsing
 from .base import DotConvBase
 from .utils import smart_float, tikzify
 
@@ -72,9 +73,9 @@ class Dot2PSTricksConv(DotConvBase):
         self.pencolor = ""
         self.fillcolor = ""
         self.color = ""
-        self.body += '{\n'
+        self.emit('{\n')
         DotConvBase.do_graph(self)
-        self.body += '}\n'
+        self.emit('}\n')
 
     def draw_ellipse(self, drawop, style=None):
         op, x, y, w, h = drawop
@@ -232,9 +233,8 @@ class Dot2PSTricksConv(DotConvBase):
                     # reset to default color
                     s += self.set_color(('c', 'black'))
             pp = []
-            for point in points:
-                p = point.split(',')
-                pp.append("(%sbp,%sbp)" % (smart_float(p[0]), smart_float(p[1])))
+            for x, y in points:
+                pp.append("(%sbp,%sbp)" % (smart_float(x), smart_float(y)))
 
             edgestyle = edge.attr.get('style', '')
             styles = []
@@ -336,7 +336,6 @@ class Dot2PSTricksNConv(Dot2PSTricksConv):
         return ""
 
     def do_nodes(self):
-        s = ""
         for node in self.nodes:
             self.currentnode = node
 
@@ -381,10 +380,10 @@ class Dot2PSTricksNConv(Dot2PSTricksConv):
                 if style == "bold":
                     psshadeoption = "linewidth=2pt," + psshadeoption
 
-            pos = getattr(node, 'pos')
+            pos = dotparsing.get_geometry(node, 'pos')
             if not pos:
                 continue
-            x, y = pos.split(',')
+            x, y = pos
             label = self.get_label(node)
             pos = "%sbp,%sbp" % (smart_float(x), smart_float(y))
             # TODO style
@@ -399,14 +398,11 @@ class Dot2PSTricksNConv(Dot2PSTricksConv):
                 sn += "\\rput(%s){\\rnode{%s}{\\%s[%s]{\\parbox[c][%sin][c]{%sin}{\\centering %s}}}}\n" % \
                       (pos, tikzify(node.name), psshape, psshadeoption, height, width, label)
             sn += self.end_node(node)
-            s += sn
-        self.body += s
+            self.emit(sn)
 
     def do_edges(self):
-        s = ""
         for edge in self.edges:
-            s += self.draw_edge(edge)
-        self.body += s
+            self.emit(self.draw_edge(edge))
 
     def draw_edge(self, edge):
         s = ""
@@ -0,0 +1,180 @@
+"""Benchmark the dot parsers on the Graphviz graph corpus
+
+Parses every lib/graphviz/graphs/**/*.gv file with the pyparsing grammar and
+with the hand-written fast parser, checks that both produce the same DotGraph
+and reports the timings.
+
+With --breakdown the cost of building the pyparsing grammar is reported
+separately from the cost of parsing with it. Packrat caching is enabled
+last for comparison; dotparsing itself leaves it off, since it is a
+process-wide pyparsing setting.
+
+With --memory N a graph with N edges is generated and the time and memory
+used to parse it are reported.
+
+Usage:
+    python scripts/bench_dotparsing.py [-n REPEAT] [--breakdown] [FILE ...]
+    python scripts/bench_dotparsing.py --memory 100000
+"""
+import argparse
+import glob
+import importlib
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ROOT))
+dotparsing = importlib.import_module(os.path.basename(ROOT) + '.dotparsing')
+
+
+def graph_signature(graph):
+    """Return a nested tuple describing everything build_graph produced"""
+    return (graph.name, graph.strict, graph.directed,
+            sorted(graph.attr.items()),
+            sorted(graph.default_node_attr.items()),
+            sorted(graph.default_edge_attr.items()),
+            sorted(graph.default_graph_attr.items()),
+            [(n.name, sorted(n.attr.items())) for n in graph.nodes],
+            [(e.src.name, e.src_port, e.dst.name, e.dst_port, sorted(e.attr.items()))
+             for e in dotparsing.flatten(graph.edges.values())],
+            [graph_signature(g) for g in graph.subgraphs],
+            str(graph))
+
+
+def time_parse(data, fastparse, repeat):
+    best = None
+    graph = None
+    for i in range(repeat):
+        parser = dotparsing.DotDataParser(fastparse=fastparse)
+        t0 = time.perf_counter()
+        graph = parser.parse_dot_data(data)
+        t = time.perf_counter() - t0
+        if best is None or t < best:
+            best = t
+    return best, graph
+
+
+def breakdown(files, repeat):
+    """Report grammar build cost versus pyparsing parse cost"""
+    import pyparsing
+
+    t0 = time.perf_counter()
+    for i in range(repeat):
+        grammar = dotparsing.DotDataParser().define_dot_parser()
+        grammar.parseWithTabs()
+    build = (time.perf_counter() - t0) / repeat
+
+    datas = []
+    for filename in files:
+        with open(filename, encoding='utf8', errors='replace') as f:
+            datas.append(f.read().replace('\\\n', ''))
+
+    def parse_all(grammar):
+        calls = 0
+        t0 = time.perf_counter()
+        for data in datas:
+            try:
+                grammar.parseString(data)
+                calls += 1
+            except Exception:
+                pass
+        return (time.perf_counter() - t0) / max(calls, 1), calls
+
+    # packrat caching can not be turned off again, so measure without it first
+    plain, calls = parse_all(grammar)
+    pyparsing.ParserElement.enablePackrat()
+    packrat_grammar = dotparsing.DotDataParser().define_dot_parser()
+    packrat_grammar.parseWithTabs()
+    packrat, calls = parse_all(packrat_grammar)
+    print('grammar build:                 %8.2f ms' % (build * 1000))
+    print('parse, no packrat (mean of %d): %8.2f ms' % (calls, plain * 1000))
+    print('parse, packrat    (mean of %d): %8.2f ms' % (calls, packrat * 1000))
+    print('per call before (build + parse): %8.2f ms' % ((build + plain) * 1000))
+    print('per call now (shared grammar):   %8.2f ms' % (plain * 1000))
+
+
+def generate_graph(edges):
+    """Return a laid out looking digraph with the given number of edges"""
+    nodes = max(edges // 5, 2)
+    lines = ['digraph G {',
+             '  node [fontsize=14, fontname=Helvetica, style=filled, fillcolor=white, '
+             'color=black, texmode=math, d2tdocpreamble="\\\\usetikzlibrary{shapes}"];',
+             '  edge [color=black, style=solid, arrowhead=normal, fontsize=10, '
+             'fontname=Helvetica, d2tstyle="thick"];']
+    for i in range(nodes):
+        lines.append('  n%d [label="node %d", shape=circle, color=black, style=solid, '
+                     'pos="%d,%d", width="0.75", height="0.5"];' % (i, i, i * 3, i * 7))
+    for i in range(edges):
+        src, dst = i % nodes, (i * 7 + 1) % nodes
+        lines.append('  n%d -> n%d [color=black, style=solid, pos="e,%d,%d %d,%d %d,%d"];'
+                     % (src, dst, i, i + 1, i + 2, i + 3, i + 4, i + 5))
+    lines.append('}')
+    return '\n'.join(lines)
+
+
+def memory(edges):
+    """Report time and memory used to parse a generated graph"""
+    data = generate_graph(edges)
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    graph = dotparsing.DotDataParser().parse_dot_data(data)
+    t = time.perf_counter() - t0
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%d nodes, %d edges' % (len(list(graph.allnodes)), len(list(graph.alledges))))
+    print('parse time (traced): %8.2f s' % t)
+    print('graph size:          %8.1f MB' % (current / 2.0 ** 20))
+    print('peak:                %8.1f MB' % (peak / 2.0 ** 20))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('-n', '--repeat', type=int, default=3)
+    argparser.add_argument('--breakdown', action='store_true',
+                           help='time grammar build versus parse')
+    argparser.add_argument('--memory', type=int, metavar='EDGES',
+                           help='parse a generated graph with EDGES edges')
+    argparser.add_argument('files', nargs='*')
+    args = argparser.parse_args()
+    if args.memory:
+        memory(args.memory)
+        return 0
+    files = args.files or sorted(glob.glob(os.path.join(ROOT, 'lib', 'graphviz', 'graphs', '**', '*.gv'),
+                                           recursive=True))
+    if args.breakdown:
+        breakdown(files, args.repeat)
+        return 0
+    total_slow = total_fast = 0.0
+    compared = mismatches = skipped = 0
+    for filename in files:
+        with open(filename, encoding='utf8', errors='replace') as f:
+            data = f.read()
+        name = os.path.relpath(filename, ROOT)
+        try:
+            slow, slow_graph = time_parse(data, False, args.repeat)
+        except Exception as err:
+            # compare only what the pyparsing grammar can handle
+            print('%-50s pyparsing failed: %s' % (name, type(err).__name__))
+            skipped += 1
+            continue
+        fast, fast_graph = time_parse(data, True, args.repeat)
+        compared += 1
+        total_slow += slow
+        total_fast += fast
+        same = graph_signature(slow_graph) == graph_signature(fast_graph)
+        if not same:
+            mismatches += 1
+        print('%-50s %9.2f ms %9.2f ms %6.1fx %s' % (name, slow * 1000, fast * 1000, slow / fast,
+                                                  'ok' if same else 'MISMATCH'))
+    print()
+    print('%d graphs compared, %d mismatches, %d skipped' % (compared, mismatches, skipped))
+    if total_fast:
+        print('pyparsing %.1f ms, fast parser %.1f ms, speedup %.1fx' % (
+            total_slow * 1000, total_fast * 1000, total_slow / total_fast))
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
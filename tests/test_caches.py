@@ -0,0 +1,75 @@
+"""Tests of the on-disk caches"""
+import os
+import zlib
+
+from .. import base
+from .. import dotparsing
+
+DOT = '''digraph g {
+    node [shape=box];
+    a:n -> b:s [label="x"];
+    subgraph cluster_s {label="<s>"; c; d [label=<<b>html</b>>]}
+    a -> {c d} -> e;
+    "été" -- f;
+}
+'''
+
+
+def test_parse_cache_round_trip(tmp_path):
+    expected = str(dotparsing.DotDataParser().parse_dot_data(DOT))
+    cache = dotparsing.DotParseCache(cachedir=str(tmp_path))
+    assert str(cache.parse_dot_data(DOT)) == expected
+    # from the in-memory tier and from disk
+    assert str(cache.parse_dot_data(DOT)) == expected
+    assert str(dotparsing.DotParseCache(cachedir=str(tmp_path)).parse_dot_data(DOT)) == expected
+    names = os.listdir(str(tmp_path))
+    assert names == [cache.key(DOT) + '.events']
+    with open(os.path.join(str(tmp_path), names[0]), 'rb') as f:
+        assert zlib.decompress(f.read()).startswith(b'[["start_graph","g",false,true]')
+
+
+def test_parse_cache_returns_independent_graphs():
+    cache = dotparsing.DotParseCache()
+    first = cache.parse_dot_data(DOT)
+    expected = str(first)
+    first.add_node('z', color='red')
+    first.get_node('a').attr['color'] = 'blue'
+    first.allitems = []
+    second = cache.parse_dot_data(DOT)
+    assert second is not first
+    assert str(second) == expected
+    assert second.get_node('z') is None
+
+
+def test_parse_cache_discards_unreadable_entries(tmp_path):
+    cache = dotparsing.DotParseCache(cachedir=str(tmp_path))
+    key = cache.key(DOT)
+    with open(os.path.join(str(tmp_path), key + '.events'), 'wb') as f:
+        f.write(b'not an entry')
+    assert cache.get(key) is None
+    assert str(cache.parse_dot_data(DOT)) == str(dotparsing.DotDataParser().parse_dot_data(DOT))
+
+
+def test_layout_cache_round_trip(tmp_path):
+    cachedir = str(tmp_path)
+    cache = base.LayoutCache(cachedir=cachedir)
+    record = {'labels': 'x', 'nodes': {'a': '1,2'}, 'edges': [[['a', 'b', '', ''], ['e,1,2 3,4', None]]],
+              'graphs': {}}
+    entries = [('bytes', b'digraph {\n}\n', [('warning', 'w')]), ('text', 'digraph {\n}\n', []),
+               ('record', record, [])]
+    for key, data, messages in entries:
+        cache.put(key, data, messages)
+    for cache in (base.LayoutCache(cachedir=cachedir), base.LayoutCache(cachedir=cachedir, maxbytes=0)):
+        for key, data, messages in entries:
+            assert cache.get(key) == (data, messages)
+    # the entries are plain text, not pickles
+    with open(os.path.join(cachedir, 'bytes.layout'), 'rb') as f:
+        assert zlib.decompress(f.read()) == b'{"messages": [["warning", "w"]]}\ndigraph {\n}\n'
+
+
+def test_layout_cache_discards_unreadable_entries(tmp_path):
+    cache = base.LayoutCache(cachedir=str(tmp_path))
+    with open(os.path.join(str(tmp_path), 'bad.layout'), 'wb') as f:
+        f.write(b'not an entry')
+    assert cache.get('bad') is None
+    assert cache.get('missing') is None
@@ -0,0 +1,51 @@
+"""Tests of the output converters"""
+import os
+
+import pytest
+
+from ..pgfformat import Dot2PGFConv, Dot2TikZConv, PositionsDotConv
+from ..pstricksformat import Dot2PSTricksConv, Dot2PSTricksNConv
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+CONVERTERS = [('pgf', Dot2PGFConv), ('tikz', Dot2TikZConv), ('pst', Dot2PSTricksConv),
+              ('psn', Dot2PSTricksNConv), ('positions', PositionsDotConv)]
+
+
+def read_graphs(name):
+    with open(os.path.join(DATA, name)) as f:
+        data = f.read()
+    return [graph + '}\n' for graph in data.split('\n}\n') if graph.strip()]
+
+
+GRAPHS = read_graphs('two_graphs.xdot') + read_graphs('edges.xdot')
+
+
+@pytest.mark.parametrize('fmt,Conv', CONVERTERS)
+@pytest.mark.parametrize('extra', [{}, {'duplicate': True}, {'codeonly': True}, {'figonly': True},
+                                   {'edgeoptions': 'thick', 'nodeoptions': 'red'}],
+                         ids=['default', 'duplicate', 'codeonly', 'figonly', 'scopes'])
+def test_convert_iter_matches_convert(fmt, Conv, extra):
+    for data in GRAPHS:
+        output = Conv(dict(format=fmt, **extra)).convert(data)
+        chunks = list(Conv(dict(format=fmt, **extra)).convert_iter(data))
+        if fmt == 'positions':
+            assert chunks == [output]
+        else:
+            assert all(isinstance(chunk, str) for chunk in chunks)
+            assert ''.join(chunks) == output
+
+
+@pytest.mark.parametrize('fmt,Conv', CONVERTERS[:4])
+@pytest.mark.parametrize('extra', [{}, {'duplicate': True}], ids=['default', 'duplicate'])
+def test_edges_are_emitted_one_at_a_time(fmt, Conv, extra):
+    class CountingConv(Conv):
+        def do_edges(self):
+            before = len(self.fragments)
+            super(CountingConv, self).do_edges()
+            self.edge_fragments = len(self.fragments) - before
+
+    data, = read_graphs('edges.xdot')
+    conv = CountingConv(dict(format=fmt, **extra))
+    conv.convert(data)
+    assert conv.edge_fragments >= len(conv.edges) == 4
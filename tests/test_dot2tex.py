@@ -0,0 +1,36 @@
+"""Tests of the dot2tex entry points"""
+import os
+
+from ..dot2tex import convert_graph
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def read_data(name):
+    with open(os.path.join(DATA, name)) as f:
+        return f.read()
+
+
+def split_graphs(data):
+    return [graph + '}\n' for graph in data.split('\n}\n') if graph.strip()]
+
+
+def test_convert_graph_positions():
+    first, second = split_graphs(read_data('two_graphs.xdot'))
+    positions = convert_graph(first, format='positions')
+    assert positions == {'a': [27, 121.4], 'b': [27, 25.3]}
+
+
+def test_convert_graph_positions_of_several_graphs():
+    both = convert_graph(read_data('two_graphs.xdot'), format='positions')
+    assert isinstance(both, list) and len(both) == 2
+    assert both[0] == convert_graph(split_graphs(read_data('two_graphs.xdot'))[0], format='positions')
+    assert set(both[1]) == {'c', 'd', 'e'}
+
+
+def test_convert_graph_joins_several_graphs():
+    data = read_data('two_graphs.xdot')
+    first, second = split_graphs(data)
+    tex = convert_graph(data, format='tikz')
+    assert tex == (convert_graph(first, format='tikz') + '\n'
+                   + convert_graph(second, format='tikz'))
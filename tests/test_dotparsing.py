@@ -0,0 +1,87 @@
+"""Tests of the dot parsers"""
+import glob
+import os
+
+import pytest
+
+from .. import dotparsing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS = sorted(glob.glob(os.path.join(ROOT, 'lib', 'graphviz', 'graphs', '**', '*.gv'), recursive=True))
+
+GRAPHS = [
+    'graph {}',
+    'strict digraph "my graph" { a -> b -> c; a -> b }',
+    '''digraph G {
+        // comment
+        graph [rankdir=LR, label="a \\"quoted\\" label"];
+        node [shape=box]; edge [color=red]
+        a [label=<x &amp; y>];
+        a:p:n -> b:s;
+        "x\\
+y" -> z # comment
+        /* block
+           comment */
+    }''',
+    '''graph {
+        a -- {b c} -- subgraph s {d; e} [weight=2];
+        subgraph cluster_1 { label=one; node [color=blue]; f -- g }
+        subgraph { rank=same; h; i }
+        {j k} -- l;
+        m = n;
+        -1.5 -- .5;
+        "été" -- "über";
+    }''',
+    '''digraph { edge [dir=back]; a -> b [label=1]; subgraph s { edge [dir=none]; a -> c };
+        a -> subgraph t { x; y }; subgraph t { z } -> w }''',
+]
+
+# input the fast parser leaves to the pyparsing grammar
+FALLBACK = [
+    'digraph { 1b }',
+    'digraph { a -> 1b }',
+    'digraph { a -> 12_c }',
+    'digraph { a -> 1.5.2 }',
+]
+
+
+def events(data, fastparse):
+    return list(dotparsing.DotDataParser(fastparse).iter_dot_events(data))
+
+
+@pytest.mark.parametrize('data', GRAPHS + FALLBACK)
+def test_fast_parser_matches_pyparsing(data):
+    assert events(data, True) == events(data, False)
+    graph = dotparsing.DotDataParser(True).parse_dot_data(data)
+    assert str(graph) == str(dotparsing.DotDataParser(False).parse_dot_data(data))
+
+
+@pytest.mark.parametrize('data', FALLBACK)
+def test_fast_parser_gives_up(data):
+    with pytest.raises(dotparsing.DotFastParseError):
+        dotparsing.DotFastParser().parse(data)
+
+
+def test_several_graphs():
+    data = '\n'.join(GRAPHS)
+    fast = [str(graph) for graph in dotparsing.DotDataParser(True).iter_dot_graphs(data)]
+    slow = [str(graph) for graph in dotparsing.DotDataParser(False).iter_dot_graphs(data)]
+    assert len(fast) == len(GRAPHS)
+    assert fast == slow
+
+
+@pytest.mark.skipif(not CORPUS, reason='the Graphviz graph corpus is not available')
+def test_fast_parser_matches_pyparsing_on_corpus():
+    compared = 0
+    for filename in CORPUS:
+        with open(filename, encoding='utf8', errors='replace') as f:
+            data = f.read()
+        try:
+            expected = events(data, False)
+        except Exception:
+            # empty attribute lists, nested HTML labels and non-ASCII
+            # identifiers are not handled by the pyparsing grammar
+            continue
+        assert events(data, True) == expected, filename
+        compared += 1
+    assert compared
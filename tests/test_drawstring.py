@@ -0,0 +1,72 @@
+"""Tests of the drawstring parser"""
+import os
+import re
+
+from .. import base
+from ..base import DrawColor, DrawEllipse, DrawFont, DrawPoints, DrawStyle
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def test_records():
+    cmdlist, stat = base.parse_drawstring(
+        'c 7 -#000000 C 9 -#ff000080 S 6 -dashed e 90 164 27 18 E 1.5 -2 3 4 '
+        'P 3 0 0 10 0 5 8.5 B 4 1 2 3 4 5 6 7 8 L 2 0 0 1 1 '
+        'F 14 11 -Times-Roman T 90 159.8 0 6.21 1 -a ')
+    assert cmdlist == [
+        DrawColor('c', '#000000'),
+        DrawColor('C', '#ff000080'),
+        DrawStyle('S', 'dashed'),
+        DrawEllipse('e', 90.0, 164.0, 27.0, 18.0),
+        DrawEllipse('E', 1.5, -2.0, 3.0, 4.0),
+        DrawPoints('P', [(0.0, 0.0), (10.0, 0.0), (5.0, 8.5)]),
+        DrawPoints('B', [(1.0, 2.0), (3.0, 4.0), (5.0, 6.0), (7.0, 8.0)]),
+        DrawPoints('L', [(0.0, 0.0), (1.0, 1.0)]),
+        DrawFont('F', '14', 'Times-Roman'),
+        ['T', '90', '159.8', '0', '6.21', 'a'],
+    ]
+    assert stat == {'c': 1, 'C': 1, 'S': 1, 'e': 1, 'E': 1, 'P': 1, 'B': 1, 'L': 1, 'F': 1, 'T': 1}
+    ellipse = cmdlist[3]
+    assert (ellipse.x, ellipse.y, ellipse.w, ellipse.h) == (90.0, 164.0, 27.0, 18.0)
+    # the records still compare equal to plain tuples
+    assert ellipse == ('e', 90.0, 164.0, 27.0, 18.0)
+    assert cmdlist[5].points[2] == (5.0, 8.5)
+    assert isinstance(cmdlist[9], list)
+
+
+def test_strings_are_read_by_length():
+    gradient = '[0 0 0 100;2 0.5 #ff0000 1 #0000ff]'
+    cmdlist, stat = base.parse_drawstring(
+        'F 10 15 -Helvetica Bold  T 0 0 -1 30 11 -a - b  c e '
+        'C %d -%s c 11 -0.5 1 0.75  S 4 -bold' % (len(gradient), gradient))
+    assert cmdlist == [
+        DrawFont('F', '10', 'Helvetica Bold '),
+        ['T', '0', '0', '-1', '30', 'a - b  c e '],
+        DrawColor('C', gradient),
+        DrawColor('c', '0.5 1 0.75 '),
+        DrawStyle('S', 'bold'),
+    ]
+    assert stat == {'F': 1, 'T': 1, 'C': 1, 'c': 1, 'S': 1}
+
+
+def test_font_characteristics_and_images_are_skipped():
+    cmdlist, stat = base.parse_drawstring('t 1 I 0 0 10 10 7 -img.png c 3 -red t 0')
+    assert cmdlist == [DrawColor('c', 'red')]
+    assert stat == {'t': 2, 'I': 1, 'c': 1}
+
+
+def test_bad_operations_are_skipped():
+    cmdlist, stat = base.parse_drawstring('e 1 2 x 4 c 3 -red Q 1 P 2 0 0')
+    assert DrawColor('c', 'red') in cmdlist
+    assert stat['e'] == 1 and stat['Q'] == 1
+
+
+def test_format_drawstring_round_trip():
+    with open(os.path.join(DATA, 'edges.xdot')) as f:
+        data = f.read().replace('\\\n', '')
+    drawstrings = re.findall(r'_[a-z]*draw_="([^"]*)"', data)
+    assert drawstrings
+    for drawstring in drawstrings:
+        cmdlist, stat = base.parse_drawstring(drawstring)
+        assert base.format_drawstring(cmdlist) == drawstring.strip()
+        assert base.parse_drawstring(base.format_drawstring(cmdlist)) == (cmdlist, stat)
@@ -0,0 +1,112 @@
+"""Tests of the persistent Graphviz workers, driven by a stand-in for dot"""
+import sys
+import textwrap
+
+import pytest
+
+from .. import base
+
+# Echoes every graph as a minimal xdot frame. With --readahead a graph is
+# only written once the first token after it has been read, like a parser
+# that needs a lookahead token. Graphs named noout produce no output.
+FAKE_DOT = textwrap.dedent('''
+    import os, re, sys
+
+    readahead = '--readahead' in sys.argv
+    warned = set()
+
+    def read():
+        return os.read(0, 1).decode('latin-1')
+
+    def emit(graph):
+        name = re.match(r'\\s*(?:strict\\s+)?(?:di)?graph\\s+(\\w*)', graph).group(1)
+        for shape in re.findall(r'shape=(\\w+)', graph):
+            if shape.startswith('dot2tex_sync') or shape.startswith('bogus'):
+                if shape not in warned:
+                    warned.add(shape)
+                    sys.stderr.write('Warning: using box for unknown shape %s\\n' % shape)
+                    sys.stderr.flush()
+        if name != 'noout':
+            sys.stdout.write('digraph %s {\\n\\tgraph [bb="0,0,1,1"];\\n}\\n' % name)
+            sys.stdout.flush()
+
+    ch = read()
+    while ch:
+        graph, depth, quoted = '', 0, False
+        while ch:
+            graph += ch
+            if quoted:
+                quoted = ch != '"'
+            elif ch == '"':
+                quoted = True
+            elif ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+            ch = read()
+        ch = read()
+        if readahead:
+            while ch and ch.isspace():
+                ch = read()
+        if graph.strip():
+            emit(graph)
+''')
+
+
+@pytest.fixture(params=[False, True], ids=['eager', 'readahead'])
+def fake_dot(request, tmp_path):
+    script = tmp_path / 'fakedot.py'
+    script.write_text(FAKE_DOT)
+    args = [sys.executable, str(script)]
+    if request.param:
+        args.append('--readahead')
+    return args
+
+
+def test_layout_several_graphs(fake_dot):
+    worker = base.GraphvizWorker(fake_dot)
+    try:
+        for i in range(5):
+            data, messages = worker.layout('digraph g%d {a [shape=bogus%d]; b [label="}"]}' % (i, i),
+                                           timeout=10)
+            assert data.startswith(b'digraph g%d {' % i)
+            assert base.GRAPHVIZ_SYNC_NAME not in data
+            assert [text for level, text in messages] == ['using box for unknown shape bogus%d' % i]
+        assert worker.ping()
+        assert worker.alive()
+    finally:
+        worker.close()
+
+
+def test_missing_output_breaks_worker(fake_dot):
+    worker = base.GraphvizWorker(fake_dot)
+    try:
+        worker.layout('digraph first {}', timeout=10)
+        with pytest.raises(base.GraphvizWorkerError):
+            worker.layout('digraph noout {}', timeout=10)
+        assert not worker.alive()
+    finally:
+        worker.close()
+
+
+def test_exited_process(tmp_path):
+    worker = base.GraphvizWorker([sys.executable, '-c', 'pass'])
+    try:
+        with pytest.raises(base.GraphvizWorkerError):
+            worker.layout('digraph g {}', timeout=10)
+        assert not worker.alive()
+    finally:
+        worker.close()
+
+
+def test_pool_reuses_and_checks_workers(fake_dot):
+    pool = base.GraphvizPool(fake_dot, maxworkers=2)
+    try:
+        for i in range(3):
+            data, messages = pool.layout('graph g%d {}' % i, timeout=10)
+            assert data.startswith(b'digraph g%d {' % i)
+        assert pool.check() == 1
+    finally:
+        pool.close()